@@ -0,0 +1,307 @@
+'''This file is part of Maxfield.
+Maxfield is a planning tool for helping Ingress players to determine
+an efficient plan to create many in-game fields.
+
+Copyright (C) 2015 by Jonathan Baker: babamots@gmail.com
+
+
+Maxfield is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Maxfield is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Maxfield.  If not, see <http://www.gnu.org/licenses/>.
+'''
+# Links of a plan, stored as one array per attribute
+
+import numpy as np
+
+class LinkTable:
+    def __init__(self,n):
+        '''
+        Links between n portals
+
+        Link i goes from portal origin[i] to portal dest[i]
+            order[i] is its position in the sequence of links to be made
+            reversible[i] is True if its direction does not affect the plan
+        Links are added in the order they are first planned (so order[i] starts out as i)
+
+        indeg[p] and outdeg[p] count the links into and out of portal p
+
+        The fields completed by link i are the rows of
+            fieldVerts[fieldStart[i]:fieldStart[i+1]]
+        each row holds the 3 portals of a field
+        '''
+        self.n = n
+        self.m = 0
+
+        # Arrays have room for more links than m
+        # origin, dest, order and reversible are views of the used part
+        self._origin     = np.empty(16,dtype=int)
+        self._dest       = np.empty(16,dtype=int)
+        self._order      = np.empty(16,dtype=int)
+        self._reversible = np.empty(16,dtype=bool)
+        self._view()
+
+        self.indeg  = np.zeros(n,dtype=int)
+        self.outdeg = np.zeros(n,dtype=int)
+
+        # _pairs[p*n+q] is the link between p and q (p<q), whichever its direction
+        self._pairs = {}
+        # _incident[p] lists the links touching p in the order they were added
+        self._incident = [[] for p in xrange(n)]
+
+        # Every change, so that it can be undone (see mark and undo)
+        self._log = []
+        # _logIds[k] is a number given to _log[k] that no other change gets (marks check it)
+        self._logIds = []
+        self._nextId = 1
+
+        # Fields are collected in lists and packed into arrays when they are read
+        self._fieldLinks = []
+        self._fieldRows  = []
+        self._pack = None
+
+    def _view(self):
+        m = self.m
+        self.origin     = self._origin    [:m]
+        self.dest       = self._dest      [:m]
+        self.order      = self._order     [:m]
+        self.reversible = self._reversible[:m]
+
+    def __len__(self):
+        return self.m
+
+    def __getstate__(self):
+        # Views would be pickled as copies
+        state = self.__dict__.copy()
+        for name in ['_origin','_dest','_order','_reversible']:
+            state[name] = state[name][:self.m].copy()
+        for name in ['origin','dest','order','reversible']:
+            del state[name]
+        # The packed fields are remade from _fieldLinks and _fieldRows when read
+        state['_pack'] = None
+        # A loaded table starts a new log, and the lookups are remade from the links
+        for name in ['_log','_logIds','_nextId','_pairs','_incident']:
+            del state[name]
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._log = []
+        self._logIds = []
+        self._nextId = 1
+        self._pairs = {}
+        self._incident = [[] for p in xrange(self.n)]
+        origin = self._origin[:self.m].tolist()
+        dest   = self._dest  [:self.m].tolist()
+        for i in xrange(self.m):
+            p = origin[i]
+            q = dest[i]
+            self._pairs[self._key(p,q)] = i
+            self._incident[p].append(i)
+            self._incident[q].append(i)
+        self._view()
+
+    def _key(self,p,q):
+        if p < q:
+            return p*self.n+q
+        return q*self.n+p
+
+    def add(self,p,q,reversible):
+        '''
+        Adds a link from p to q, made after all the others
+        returns its index
+        '''
+
+        i = self.m
+        if i == len(self._origin):
+            for name in ['_origin','_dest','_order','_reversible']:
+                old = getattr(self,name)
+                new = np.empty(2*i,dtype=old.dtype)
+                new[:i] = old
+                setattr(self,name,new)
+
+        self._origin[i] = p
+        self._dest[i] = q
+        self._order[i] = i
+        self._reversible[i] = reversible
+        self.outdeg[p] += 1
+        self.indeg[q] += 1
+        self._pairs[self._key(p,q)] = i
+        self._incident[p].append(i)
+        self._incident[q].append(i)
+        self._logChange(i)
+
+        self.m += 1
+        self._view()
+        return i
+
+    def find(self,p,q):
+        # The index of the link between p and q (either direction), None if there is none
+        return self._pairs.get(self._key(p,q))
+
+    def reverse(self,i):
+        self._flip(i)
+        # Reversals are logged as negative numbers
+        self._logChange(-1-i)
+
+    def _logChange(self,entry):
+        self._log.append(entry)
+        self._logIds.append(self._nextId)
+        self._nextId += 1
+
+    def _flip(self,i):
+        p = self._origin[i]
+        q = self._dest[i]
+        self._origin[i] = q
+        self._dest[i] = p
+        self.outdeg[p] -= 1
+        self.indeg[p] += 1
+        self.outdeg[q] += 1
+        self.indeg[q] -= 1
+
+    def outLinks(self,p):
+        # The links from p
+        return [i for i in self._incident[p] if self._origin[i] == p]
+
+    def incident(self,p):
+        # The links touching p in the order they were added (do not change the list)
+        return self._incident[p]
+
+    def mark(self):
+        # Pass this to undo to return to the current state
+        k = len(self._log)
+        if k == 0:
+            return (0,None)
+        return (k,self._logIds[k-1])
+
+    def undo(self,mark):
+        '''
+        Undoes every add and reverse since mark was made
+        Raises ValueError if a change made before mark was undone since
+            (this includes undoing to mark and making new changes after)
+        '''
+        k,lastId = mark
+        log = self._log
+        if k > len(log) or k > 0 and self._logIds[k-1] != lastId:
+            raise ValueError('This mark is no longer valid (changes made before it were undone)')
+        while len(log) > k:
+            self._logIds.pop()
+            i = log.pop()
+            if i < 0:
+                # Reverse it back
+                self._flip(-1-i)
+                continue
+            p = self._origin[i]
+            q = self._dest[i]
+            self.outdeg[p] -= 1
+            self.indeg[q] -= 1
+            del self._pairs[self._key(p,q)]
+            # Links are undone in the reverse order they were added
+            self._incident[p].pop()
+            self._incident[q].pop()
+            self.m = i
+        self._view()
+
+        if len(self._fieldLinks) > 0 and max(self._fieldLinks) >= self.m:
+            keep = [j for j in xrange(len(self._fieldLinks)) if self._fieldLinks[j] < self.m]
+            self._fieldLinks = [self._fieldLinks[j] for j in keep]
+            self._fieldRows  = [self._fieldRows [j] for j in keep]
+            self._pack = None
+
+    def addField(self,i,verts):
+        # Link i completes the field verts
+        self._fieldLinks.append(i)
+        self._fieldRows.append(verts)
+        self._pack = None
+
+    def clearFields(self):
+        # Forget the fields of every link (before marking them again)
+        self._fieldLinks = []
+        self._fieldRows  = []
+        self._pack = None
+
+    def packedFields(self):
+        '''
+        returns fieldStart,fieldVerts (see __init__)
+        '''
+        if self._pack is None:
+            links = np.array(self._fieldLinks,dtype=int)
+            # Each link's fields stay in the order they were added
+            sort = np.argsort(links,kind='mergesort')
+            fieldVerts = np.array(self._fieldRows,dtype=int).reshape([-1,3])[sort]
+            fieldStart = np.zeros(self.m+1,dtype=int)
+            fieldStart[1:] = np.cumsum(np.bincount(links,minlength=self.m))
+            self._pack = (fieldStart,fieldVerts)
+        return self._pack
+
+    def fields(self,i):
+        # The fields completed by link i (one per row)
+        fieldStart,fieldVerts = self.packedFields()
+        return fieldVerts[fieldStart[i]:fieldStart[i+1]]
+
+    def fieldCounts(self):
+        # The number of fields completed by each link
+        fieldStart,fieldVerts = self.packedFields()
+        return np.diff(fieldStart)
+
+    def reorder(self,orderedLinks):
+        # The ith link to be made will be orderedLinks[i]
+        self.order[orderedLinks] = np.arange(self.m)
+
+    def byOrder(self):
+        # The indices of links in the order they are to be made
+        links = np.empty(self.m,dtype=int)
+        links[self.order] = np.arange(self.m)
+        return links
+
+    def edges(self):
+        # (origin,dest) of each link in the order they are to be made
+        byOrder = self.byOrder()
+        return zip(self.origin[byOrder].tolist(),self.dest[byOrder].tolist())
+
+    def toGraph(self):
+        '''
+        returns a networkx DiGraph of the portals and links
+            the edge p,q has the attributes order, reversible and fields
+        '''
+        import networkx as nx
+        b = nx.DiGraph()
+        b.add_nodes_from(xrange(self.n))
+        for i in xrange(self.m):
+            b.add_edge(int(self.origin[i]),int(self.dest[i]),\
+                       {'order':self.order[i],\
+                        'reversible':self.reversible[i],\
+                        'fields':[list(verts) for verts in self.fields(i)]})
+        return b
+
+def fromGraph(a):
+    '''
+    Makes a LinkTable from the edge attributes of plan graph a
+    (this is how links were stored before LinkTable)
+    '''
+    edges = sorted(a.edges_iter(data=True),key=lambda e: e[2]['order'])
+    links = LinkTable(a.order())
+    for p,q,attr in edges:
+        i = links.add(p,q,attr['reversible'])
+        for verts in attr['fields']:
+            links.addField(i,verts)
+    return links
+
+def linksOf(a):
+    '''
+    Returns the LinkTable of plan a
+    Plans saved before LinkTable get one made from their edge attributes
+    '''
+    try:
+        return a.links
+    except AttributeError:
+        a.links = fromGraph(a)
+        return a.links
@@ -31,6 +31,7 @@ import agentOrder
 import networkx as nx
 import electricSpring
 import time
+from multiprocessing import Pool
 
 # returns the points in a shrunken toward their centroid
 def shrink(a):
@@ -42,23 +43,63 @@ def commaGroup(n):
     s = str(n)
     return ','.join([ s[max(i,0):i+3] for i in range(len(s)-3,-3,-3)][::-1])
 
+def agentSweep(a,outputDir,counts,timeBudget=None):
+    '''
+    Assigns the links of plan a for each number of agents in counts
+        The searches run in parallel and share the work that doesn't depend on the number of agents
+    Writes a table comparing the numbers of agents to agentSweep.txt
+    '''
+    orderedEdges = agentOrder.getOrderedEdges(a)
+    d,condensed,mult = agentOrder.originVisits(a,orderedEdges)
+    # Compute all the distances before they are copied to the workers
+    for p in set(condensed):
+        d.row(p)
+
+    print 'Assigning links for',', '.join([str(k) for k in counts]),'agents'
+    jobs = [ (k,d,condensed,mult,timeBudget,False) for k in counts ]
+    pool = Pool()
+    assignments = pool.map(agentOrder.sweepVisits,jobs)
+    pool.close()
+
+    rowFormat = '{0:6d} | {1:7d} | {2:8d} | {3:12d} | {4:12.2f}\n'
+    with open(outputDir+'agentSweep.txt','w') as fout:
+        fout.write('Agents | Minutes | Distance | AP per Agent | AP/Agent/min      %s\n'\
+            %time.strftime('%Y-%m-%d %H:%M:%S %Z'))
+        for k,assignment in zip(counts,assignments):
+            PP = PlanPrinter(a,outputDir,k,assignment=assignment)
+            agentdists,agentlinkcount,agentfieldcount,totalAP,totalDist,totalTime = PP.planStats()
+            minutes = int(totalTime/60+.5)
+            fout.write(rowFormat.format(\
+                k,\
+                minutes,\
+                int(totalDist),\
+                totalAP//k,\
+                float(totalAP)/k/(totalTime/60.)\
+            ))
+
 class PlanPrinter:
-    def __init__(self,a,outputDir,nagents,color='#FF004D'):
+    def __init__(self,a,outputDir,nagents,color='#FF004D',timeBudget=None,assignment=None):
+        '''
+        timeBudget: seconds allowed for assigning links to agents
+        assignment: if given, the output of agentOrder.agentVisits to use instead of searching
+        '''
         self.a = a
         self.n = a.order() # number of nodes
-        self.m = a.size()  # number of links
+        self.m = len(a.links)  # number of links
 
         self.nagents = nagents
         self.outputDir = outputDir
         self.color = color
 
         # if the ith link to be made is (p,q) then orderedEdges[i] = (p,q)
-        self.orderedEdges = [None]*self.m
-        for e in a.edges_iter():
-            self.orderedEdges[a.edge[e[0]][e[1]]['order']] = e
+        self.orderedEdges = agentOrder.getOrderedEdges(a)
+        # the ith link to be made is a.links[orderedLinks[i]]
+        self.orderedLinks = a.links.byOrder()
+        # the number of fields the ith link completes
+        self.numfields = a.links.fieldCounts()[self.orderedLinks]
 
         # movements[i][j] is the index (in orderedEdges) of agent i's jth link
-        self.movements = agentOrder.getAgentOrder(a,nagents,self.orderedEdges)
+        self.movements = agentOrder.getAgentOrder(a,nagents,self.orderedEdges,timeBudget,assignment)
 
         # link2agent[i] is the agent that will make the ith link
         self.link2agent = [-1]*self.m
@@ -73,12 +114,12 @@ class PlanPrinter:
                 p,q = self.orderedEdges[e]
                 self.agentkeyneeds[i][q] += 1
 
-        self.names = np.array([a.node[i]['name'] for i in xrange(self.n)])
+        self.names = a.portals.name
         # The alphabetical order
         makeLowerCase = np.vectorize(lambda s: s.lower())
         self.nameOrder = np.argsort(makeLowerCase(self.names))
 
-        self.xy = np.array([self.a.node[i]['xy'] for i in xrange(self.n)])
+        self.xy = a.portals.xy
 
         # The order from north to south (for easy-to-find labels)
         self.posOrder = np.argsort(self.xy,axis=0)[::-1,1]
@@ -88,7 +129,7 @@ class PlanPrinter:
         for i in xrange(self.n):
             self.nslabel[self.posOrder[i]] = i
 
-        self.maxNameLen = max([len(a.node[i]['name']) for  i in xrange(self.n)])
+        self.maxNameLen = max([len(name) for name in self.names])
 
     def keyPrep(self):
         rowFormat = '{0:11d} | {1:6d} | {2}\n'
@@ -96,9 +137,9 @@ class PlanPrinter:
             fout.write( 'Keys Needed | Lacked |                                  %s\n'\
                 %time.strftime('%Y-%m-%d %H:%M:%S %Z'))
             for i in self.nameOrder:
-                keylack = max(self.a.in_degree(i)-self.a.node[i]['keys'],0)
+                keylack = max(self.a.links.indeg[i]-self.a.portals.keys[i],0)
                 fout.write(rowFormat.format(\
-                    self.a.in_degree(i),\
+                    self.a.links.indeg[i],\
                     keylack,\
                     self.names[i]\
                 ))
@@ -184,7 +225,7 @@ class PlanPrinter:
 
 ### The code below works. It just uses networkx draw functions
         if edges is None:
-            b = self.a
+            b = self.a.links.toGraph()
         else:
             b = nx.DiGraph()
             b.add_nodes_from(xrange(self.n))
@@ -196,8 +237,7 @@ class PlanPrinter:
                 p,q = self.orderedEdges[e]
                 b.add_edge(p,q,{'order':e})
 
-        edgelabels = dict([ (e,self.a.edge[e[0]][e[1]]['order'])\
-                            for e in b.edges_iter() ])
+        edgelabels = dict([ (self.orderedEdges[e],e) for e in edges ])
 
         plt.plot(self.xy[:,0],self.xy[:,1],'o',ms=16,color=self.color)
 
@@ -209,7 +249,7 @@ class PlanPrinter:
         try:
             nx.draw_networkx_edge_labels(b,self.ptmap,edgelabels)
         except AttributeError:
-            self.ptmap   = dict([(i,self.a.node[i]['xy']) for i in xrange(self.n) ])
+            self.ptmap   = dict([(i,self.xy[i]) for i in xrange(self.n) ])
             nx.draw_networkx_edge_labels(b,self.ptmap,edgelabels)
 
         # edge_color does not seem to support arbitrary colors easily
@@ -277,8 +317,10 @@ class PlanPrinter:
 #            plt.savefig(self.outputDir+'linkMap_agent_%s_of_%s.png'%(agent+1,self.nagents))
 #            plt.clf()
 
-    def agentLinks(self):
-
+    def planStats(self):
+        '''
+        returns agentdists,agentlinkcount,agentfieldcount,totalAP,totalDist,totalTime
+        '''
         # Total distance traveled by each agent
         agentdists = np.zeros(self.nagents)
         # Total number of links, fields for each agent
@@ -289,28 +331,37 @@ class PlanPrinter:
 
         for i in range(self.nagents):
             movie = self.movements[i]
+            if len(movie) == 0:
+                continue
             # first portal in first link
-            curpos = self.a.node[self.orderedEdges[movie[0]][0]]['geo']
+            geo = self.a.portals.geo
+            curpos = geo[self.orderedEdges[movie[0]][0]]
             agentlinkcount[i] = len(movie)
-            for e in movie[1:]:
+            for e in movie:
                 p,q = self.orderedEdges[e]
-                newpos = self.a.node[p]['geo']
+                newpos = geo[p]
                 dist = geometry.sphereDist(curpos,newpos)
 #                print 'Agent %s walks %s to %s'%(i,dist,self.nslabel[p])
                 agentdists[i] += dist
                 curpos = newpos
 
-                agentfieldcount[i] += len(self.a.edge[p][q]['fields'])
+                # The first link and its fields count too (the agent just doesn't walk to it)
+                agentfieldcount[i] += self.numfields[e]
                 totalAP += 313
-                totalAP += 1250 * len(self.a.edge[p][q]['fields'])
+                totalAP += 1250 * self.numfields[e]
                 totalDist += dist
 
+        totalTime = self.a.walktime+self.a.linktime+self.a.commtime
+
+        return agentdists,agentlinkcount,agentfieldcount,totalAP,totalDist,totalTime
+
+    def agentLinks(self):
+        agentdists,agentlinkcount,agentfieldcount,totalAP,totalDist,totalTime = self.planStats()
+
         # Different formatting for the agent's own links
 #        plainStr = '{0:4d}{1:1s} {2: 5d}{3:5d} {4:s}\n            {5:4d} {6:s}\n\n'
         plainStr = '{0:4d}{1:1s} {2: 5d}{3:5d} {4:s} -> {5:d} {6:s}\n'
         hilitStr = '{0:4d}{1:1s} {2:_>5d}{3:5d} {4:s}\n            {5:4d} {6:s}\n\n'
-        
-        totalTime = self.a.walktime+self.a.linktime+self.a.commtime
 
         for agent in range(self.nagents):
             with open(self.outputDir+'links_for_agent_%s_of_%s.txt'\
@@ -324,7 +375,7 @@ class PlanPrinter:
                 fout.write('Minutes:                 %s minutes\n'%int(totalTime/60+.5))
                 fout.write('Total Distance:          %s meter\n'%int(totalDist))
                 fout.write('Total AP:                %s\n'%totalAP)
-                fout.write('AP per Agent per minute: %0.2f AP/Agent/min\n'%float(totalAP/self.nagents/(totalTime/60+.5)))
+                fout.write('AP per Agent per minute: %0.2f AP/Agent/min\n'%(float(totalAP)/self.nagents/(totalTime/60.)))
                 fout.write('AP per Agent per meter:  %0.2f AP/Agent/m\n'%float(totalAP/self.nagents/totalDist))
 
                 agentAP = 313*agentlinkcount[agent] + 1250*agentfieldcount[agent]
@@ -349,8 +400,7 @@ class PlanPrinter:
                     linkagent = self.link2agent[i]
 
                     # Put a star by links that can be completed early since they complete no fields
-                    numfields = len(self.a.edge[p][q]['fields'])
-                    if numfields == 0:
+                    if self.numfields[i] == 0:
                         star = '*'
 #                        print '%s %s completes nothing'%(p,q)
                     else:
@@ -395,11 +445,11 @@ class PlanPrinter:
         RED       = ( 1.0 , 0.0 , 0.0 , 0.5)
         INVISIBLE = ( 0.0 , 0.0 , 0.0 , 0.0 )
 
-        portals = np.array([self.a.node[i]['xy'] for i in self.a.nodes_iter()]).T
+        portals = self.xy.T
         
         # Plot all edges lightly
         def dashAllEdges():
-            for p,q in self.a.edges_iter():
+            for p,q in self.orderedEdges:
                 plt.plot(portals[0,[p,q]],portals[1,[p,q]],'k:')
 
         aptotal = 0
@@ -433,9 +483,9 @@ class PlanPrinter:
 
             # We'll display the new fields in red
             newPatches = []
-            for tri in self.a.edge[p][q]['fields']:
+            for tri in self.a.links.fields(self.orderedLinks[i]):
 #                print 'edge has a field'
-                coords = np.array([ self.a.node[v]['xy'] for v in tri ])
+                coords = self.xy[tri]
                 newPatches.append(Polygon(shrink(coords.T).T,facecolor=RED,\
                                                  edgecolor=INVISIBLE))
 #                newPatches.append(Polygon(shrink(coords.T).T,facecolor=GREEN,\
@@ -444,7 +494,7 @@ class PlanPrinter:
             
             aptotal += 313+1250*len(newPatches)
 
-            newEdge = np.array([self.a.node[p]['xy'],self.a.node[q]['xy']]).T
+            newEdge = self.xy[[p,q]].T
 
             patches += newPatches
             edges.append(newEdge)
@@ -487,7 +537,7 @@ class PlanPrinter:
         ax.cla()
 
     def split3instruct(self):
-        portals = np.array([self.a.node[i]['xy'] for i in self.a.nodes_iter()]).T
+        portals = self.xy.T
         
         gen1 = self.a.triangulation
 
@@ -502,10 +552,7 @@ class PlanPrinter:
         depth = 0
         while True:
             # newedges[i][0] has the x-coordinates of both verts of edge i
-            newedges = [ np.array([
-                                self.a.node[p]['xy'] ,\
-                                self.a.node[q]['xy']
-                         ]).T\
+            newedges = [ self.xy[[p,q]].T\
                              for j in range(len(gen1)) \
                              for p,q in gen1[j].edgesByDepth(depth)\
                        ]
@@ -0,0 +1,81 @@
+'''This file is part of Maxfield.
+Maxfield is a planning tool for helping Ingress players to determine
+an efficient plan to create many in-game fields.
+
+Copyright (C) 2015 by Jonathan Baker: babamots@gmail.com
+
+
+Maxfield is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Maxfield is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Maxfield.  If not, see <http://www.gnu.org/licenses/>.
+'''
+# Portal data, stored as one array per attribute
+
+import geometry
+np = geometry.np
+
+class PortalTable:
+    def __init__(self,name,keys,geo,xyz,xy):
+        '''
+        Row i describes portal i (node i of the plan graph)
+            name: portal names
+            keys: number of keys the agents have for each portal
+            geo:  n x 2 latitude, longitude (radians)
+            xyz:  n x 3 position on the unit sphere
+            xy:   n x 2 position in the gnomonic projection
+        '''
+        # Names are interned so that equal names share memory
+        self.name = np.array([intern(s) for s in name],dtype=object)
+        self.keys = np.array(keys,dtype=int)
+        self.geo  = np.ascontiguousarray(geo,dtype=float)
+        self.xyz  = np.ascontiguousarray(xyz,dtype=float)
+        self.xy   = np.ascontiguousarray(xy,dtype=float)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getstate__(self):
+        # The index is quick to remake
+        state = self.__dict__.copy()
+        state.pop('_index',None)
+        return state
+
+    def index(self):
+        # A geometry.GridIndex of xy (made the first time it is needed)
+        try:
+            return self._index
+        except AttributeError:
+            self._index = geometry.GridIndex(self.xy)
+            return self._index
+
+def fromNodes(a):
+    '''
+    Makes a PortalTable from the node attributes of plan graph a
+    (this is how portals were stored before PortalTable)
+    '''
+    nodes = [a.node[i] for i in xrange(a.order())]
+    return PortalTable([node['name'] for node in nodes],\
+                       [node['keys'] for node in nodes],\
+                       [node['geo' ] for node in nodes],\
+                       [node['xyz' ] for node in nodes],\
+                       [node['xy'  ] for node in nodes])
+
+def portalsOf(a):
+    '''
+    Returns the PortalTable of plan a
+    Plans saved before PortalTable get one made from their node attributes
+    '''
+    try:
+        return a.portals
+    except AttributeError:
+        a.portals = fromNodes(a)
+        return a.portals
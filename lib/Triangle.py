@@ -25,65 +25,67 @@ np = geometry.np
 # Set to False if only perfectly optimal plans should be produced
 ALLOW_SUBOPTIMAL = True
 
+# Steps of building a Triangle's links (see Triangle.build)
+BUILD_GRAPH        = 0
+BUILD_EXCEPT_FINAL = 1
+BUILD_FINAL        = 2
+
 class Deadend(Exception):
     def __init__(self,s):
         self.explain = s
 
 def try_reduce_out_degree(a,p):
     # Reverse as many edges out-edges of p as possible
-    toremove = []
-    for q in a.edge[p]:
-        if a.out_degree(q) < 8:
-            a.add_edge(q,p)
-            a.edge[q][p] = a.edge[p][q]
-            toremove.append(q)
-
-    for q in toremove:
-        a.remove_edge(p,q)
+    links = a.links
+    for i in links.outLinks(p):
+        if links.outdeg[links.dest[i]] < 8:
+            links.reverse(i)
 
 def try_ordered_edge(a,p,q,reversible):
-    if a.has_edge(p,q) or a.has_edge(q,p):
+    links = a.links
+    if links.find(p,q) is not None:
         return
 
-#    if reversible and a.out_degree(p) > a.out_degree(q):
+#    if reversible and links.outdeg[p] > links.outdeg[q]:
 #        p,q = q,p
 
-    if a.out_degree(p) >= 8:
+    if links.outdeg[p] >= 8:
         try_reduce_out_degree(a,p)
 
-    if a.out_degree(p) >= 8:
+    if links.outdeg[p] >= 8:
     # We tried but failed to reduce the out-degree of p
         if not reversible and not ALLOW_SUBOPTIMAL:
 #            print '%s already has 8 outgoing'%p
             raise(Deadend('%s already has 8 outgoing'%p))
 
-        if a.out_degree(q) >= 8:
+        if links.outdeg[q] >= 8:
             try_reduce_out_degree(a,q)
 
-        if a.out_degree(q) >= 8 and not ALLOW_SUBOPTIMAL:
+        if links.outdeg[q] >= 8 and not ALLOW_SUBOPTIMAL:
 #            print '%s and %s already have 8 outgoing'%(p,q)
             raise(Deadend('%s and %s already have 8 outgoing'%(p,q)))
 
         p,q = q,p
     
-    m = a.size()
-    a.add_edge(p,q,{'order':m,'reversible':reversible,'fields':[]})
-
-    try:
-        a.edgeStack.append( (p,q) )
-    except AttributeError:
-        a.edgeStack = [ (p,q) ]
+    links.add(p,q,reversible)
 #    print 'adding',p,q
-#    print a.edgeStack
 
-class Triangle:
-    def __init__(self,verts,a,exterior=False):
+class Triangle(object):
+    # A plan has a Triangle for each field, so they are kept small
+    __slots__ = ['verts','a','exterior','children','contents','center']
+
+    def __init__(self,verts=None,a=None,exterior=False):
         '''
         verts should be a 3-list of Portals
         verts[0] should be the final one used in linking
         exterior should be set to true if this triangle has no triangle parent
             the orientation of the outer edges of exterior Triangles do not matter
+
+        contents lists the portals inside until the Triangle is split (then it is None)
+        (Triangle() without verts is only made when loading plans saved before __slots__)
         '''
+        if verts is None:
+            return
         # If this portal is exterior, the final vertex doesn't matter
         self.verts = list(verts)
         self.a = a
@@ -98,47 +100,108 @@ class Triangle:
             self.verts[final] = self.verts[0]
             self.verts[0] = tmp
         '''
-        self.pts = np.array([a.node[p]['xyz'] for p in verts])
-        self.children = []
+        self.children = ()
         self.contents = []
         self.center = None
 
+    def __getstate__(self):
+        '''
+        The descendants are saved as the centers they were split on
+            listed parents before children, -1 for Triangles that were not split
+        (their vertices follow from the centers, see makeChildren)
+        '''
+        centers = []
+        stack = [self]
+        while len(stack) > 0:
+            t = stack.pop()
+            if t.center is None:
+                centers.append(-1)
+            else:
+                centers.append(t.center)
+            stack.extend(t.children[::-1])
+        return [int(p) for p in self.verts],self.a,self.exterior,np.array(centers,dtype=int)
+
+    def __setstate__(self,state):
+        if isinstance(state,dict):
+            # Saved before __slots__, with all of its attributes
+            self.verts = state['verts']
+            self.a = state['a']
+            self.exterior = state['exterior']
+            self.children = tuple(state['children'])
+            self.contents = None
+            self.center = state['center']
+            return
+
+        verts,a,exterior,centers = state
+        Triangle.__init__(self,verts,a,exterior)
+        stack = [self]
+        for p in centers.tolist():
+            t = stack.pop()
+            t.contents = None
+            if p != -1:
+                t.makeChildren(p)
+                stack.extend(t.children[::-1])
+
     def findContents(self,candidates=None):
         if candidates is None:
-            candidates = xrange(self.a.order())
-        for p in candidates:
-            if p in self.verts:
-                continue
-            if geometry.sphereTriContains(self.pts,self.a.node[p]['xyz']):
-                self.contents.append(p)
+            # Sides are straight in the gnomonic projection, so contents are in the bounding box
+            xy = self.a.portals.xy[self.verts]
+            candidates = self.a.portals.index().query(xy.min(0),xy.max(0))
+        candidates = np.asarray(candidates,dtype=int)
+        v0,v1,v2 = self.verts
+        candidates = candidates[(candidates != v0) & (candidates != v1) & (candidates != v2)]
+        if len(candidates) == 0:
+            return
+        xyz = self.a.portals.xyz
+        inside = geometry.sphereTriContains(xyz[self.verts],xyz[candidates])
+        self.contents.extend(candidates[inside].tolist())
 
     def randSplit(self):
-        if len(self.contents) == 0:
-            return
-        
-        p = self.contents[np.random.randint(len(self.contents))]
-        
-        self.splitOn(p)
+        # Splits this Triangle and its descendants (parents before children) on random portals
+        stack = [self]
+        while len(stack) > 0:
+            t = stack.pop()
+            if len(t.contents) == 0:
+                t.contents = None
+                continue
+
+            p = t.contents[np.random.randint(len(t.contents))]
 
-        for child in self.children:
-            child.randSplit()
+            t.splitOn(p)
+            stack.extend(t.children[::-1])
 
     def nearSplit(self):
         # Split on the node closest to final
-        if len(self.contents) == 0:
-            return
-        contentPts = np.array([self.a.node[p]['xyz'] for p in self.contents])
-        displaces = contentPts - self.a.node[self.verts[0]]['xyz']
-        dists = np.sum(displaces**2,1)
-        closest = np.argmin(dists)
-
-        self.splitOn(self.contents[closest])
+        xyz = self.a.portals.xyz
+        stack = [self]
+        while len(stack) > 0:
+            t = stack.pop()
+            if len(t.contents) == 0:
+                t.contents = None
+                continue
+            displaces = xyz[t.contents] - xyz[t.verts[0]]
+            dists = np.sum(displaces**2,1)
+            closest = np.argmin(dists)
 
-        for child in self.children:
-            child.nearSplit()
+            t.splitOn(t.contents[closest])
+            stack.extend(t.children[::-1])
 
     def splitOn(self,p):
         # Splits this Triangle to produce 3 children using portal p
+        self.makeChildren(p)
+
+        # Sort all my other contents into the children at once
+        contents = np.array([q for q in self.contents if q != p],dtype=int)
+        self.contents = None
+        if len(contents) == 0:
+            return
+        xyz = self.a.portals.xyz
+        which = geometry.sphereTriSplit(xyz[self.verts],xyz[p],xyz[contents])
+        for i in range(3):
+            self.children[i].contents = contents[which==i].tolist()
+
+    def makeChildren(self,p):
+        # Makes the 3 children that split this Triangle on portal p (without their contents)
         # p is passed as the first vertex parameter in the construction of 'opposite', so it will be opposite's 'final vertex' unless randomization is used
 
         # 'opposite' is the child that does not share the final vertex
@@ -153,104 +216,112 @@ class Triangle:
                                self.verts[1],p],self.a)\
                     ]
         
-        self.children = [opposite]+adjacents
+        self.children = tuple([opposite]+adjacents)
         self.center = p
 
-        for child in self.children:
-            child.findContents(self.contents)
-
     def tostr(self):
         # Just a string representation of the triangle
-        return str([self.a.node[self.verts[i]]['name'] for i in range(3)])
+        return str([self.a.portals.name[self.verts[i]] for i in range(3)])
+
+    def build(self,step):
+        '''
+        Makes the links of step (one of the BUILD_ constants) for this Triangle
+            BUILD_GRAPH:        all of them (BUILD_EXCEPT_FINAL, then BUILD_FINAL)
+            BUILD_EXCEPT_FINAL: all but the ones from the final vertex
+                                (BUILD_GRAPH for child 0, BUILD_EXCEPT_FINAL for children 1 and 2)
+            BUILD_FINAL:        the ones from the final vertex
+                                (and BUILD_FINAL for children 1 and 2)
+        Steps of descendants wait on a stack, so deep trees don't hit the recursion limit
+        '''
+        stack = [(step,self)]
+        while len(stack) > 0:
+            step,t = stack.pop()
+            if step == BUILD_GRAPH:
+#                print 'building',t.tostr()
+                # Only a safety check: makeFields builds each first generation triangle
+                # before either edge of its final vertex exists (see triangulateInterval)
+                links = t.a.links
+                if links.find(t.verts[0],t.verts[1]) is not None and \
+                   links.find(t.verts[0],t.verts[2]) is not None:
+#                    print 'Final vertex completed!!!'
+                    raise Deadend('Final vertex completed by neighbors')
+                stack.append((BUILD_FINAL,t))
+                stack.append((BUILD_EXCEPT_FINAL,t))
+
+            elif step == BUILD_EXCEPT_FINAL:
+#                print 'building EXCEPT final',t.tostr()
+                if len(t.children) == 0:
+#                    print 'no children'
+                    p,q = t.verts[2] , t.verts[1]
+                    try_ordered_edge(t.a,p,q,True)
+                    continue
+
+                stack.append((BUILD_EXCEPT_FINAL,t.children[2]))
+                stack.append((BUILD_EXCEPT_FINAL,t.children[1]))
+                # Child 0 is guaranteed to be the one opposite final
+                stack.append((BUILD_GRAPH,t.children[0]))
+
+            else:
+#                print 'building final',t.tostr()
+                if t.exterior:
+                    # Avoid making the final the link origin when possible
+#                    print t.tostr(),'is exterior'
+                    try_ordered_edge(t.a,t.verts[1],\
+                                       t.verts[0],t.exterior)
+                    try_ordered_edge(t.a,t.verts[2],\
+                                       t.verts[0],t.exterior)
+                else:
+#                    print t.tostr(),'is NOT exterior'
+                    try_ordered_edge(t.a,t.verts[0],\
+                                       t.verts[1],t.exterior)
+                    try_ordered_edge(t.a,t.verts[0],\
+                                       t.verts[2],t.exterior)
+
+                if len(t.children) > 0:
+                    stack.append((BUILD_FINAL,t.children[2]))
+                    stack.append((BUILD_FINAL,t.children[1]))
 
     def buildFinal(self):
-#        print 'building final',self.tostr()
-        if self.exterior:
-            # Avoid making the final the link origin when possible
-#            print self.tostr(),'is exterior'
-            try_ordered_edge(self.a,self.verts[1],\
-                               self.verts[0],self.exterior)
-            try_ordered_edge(self.a,self.verts[2],\
-                               self.verts[0],self.exterior)
-        else:
-#            print self.tostr(),'is NOT exterior'
-            try_ordered_edge(self.a,self.verts[0],\
-                               self.verts[1],self.exterior)
-            try_ordered_edge(self.a,self.verts[0],\
-                               self.verts[2],self.exterior)
-
-        if len(self.children) > 0:
-            for i in [1,2]:
-                self.children[i].buildFinal()
+        self.build(BUILD_FINAL)
 
     def buildExceptFinal(self):
-#        print 'building EXCEPT final',self.tostr()
-        if len(self.children) == 0:
-#            print 'no children'
-            p,q = self.verts[2] , self.verts[1]
-            try_ordered_edge(self.a,p,q,True)
-            return
-
-        # Child 0 is guaranteed to be the one opposite final
-        self.children[0].buildGraph()
-
-        for child in self.children[1:3]:
-            child.buildExceptFinal()
+        self.build(BUILD_EXCEPT_FINAL)
 
     def buildGraph(self):
-#        print 'building',self.tostr()
-        '''
-        TODO
-        A first generation triangle could have its final vertex's edges already completed by neighbors.
-        This will cause the first generation to be completed when the opposite edge is added which complicates completing inside descendants.
-        This could be solved by choosing a new final vertex (or carefully choosing the order of completion of first generation triangles).
-        '''
-        if (                                                \
-            self.a.has_edge(self.verts[0],self.verts[1]) or \
-            self.a.has_edge(self.verts[1],self.verts[0])    \
-           ) and                                            \
-           (                                                \
-            self.a.has_edge(self.verts[0],self.verts[2]) or \
-            self.a.has_edge(self.verts[2],self.verts[0])    \
-           ):
-#            print 'Final vertex completed!!!'
-            raise Deadend('Final vertex completed by neighbors')
-        self.buildExceptFinal()
-        self.buildFinal()
+        self.build(BUILD_GRAPH)
 
     def contains(self,pt):
-        return np.all(np.sum(self.orths*(pt-self.pts),1) < 0)
+        return geometry.sphereTriContains(self.a.portals.xyz[self.verts],pt)[0]
 
-    # Attach to each edge a list of fields that it completes
+    # Record with each link the fields that it completes
     def markEdgesWithFields(self):
-        edges = [(0,0)]*3
-        for i in range(3):
-            p = self.verts[i-1]
-            q = self.verts[i-2]
-            if not self.a.has_edge(p,q):
-                p,q = q,p
-            # The graph should have been completed by now, so the edge p,q exists
-            edges[i] = (p,q)
-            if not self.a.has_edge(p,q):
-                print 'a does NOT have edge',p,q
-                print 'there is a programming error'
-                print 'a only has the edges:'
-                for p,q in self.a.edges_iter():
-                    print p,q
-                print 'a has %s 1st gen triangles:'%len(self.a.triangulation)
-                for t in self.a.triangulation:
-                    print t.verts
-
-        edgeOrders = [self.a.edge[p][q]['order'] for p,q in edges]
-
-        lastInd = np.argmax(edgeOrders)
-        # The edge that completes this triangle
-        p,q = edges[lastInd]
-
-        self.a.edge[p][q]['fields'].append(self.verts)
-
-        for child in self.children:
-            child.markEdgesWithFields()
+        links = self.a.links
+        order = links.order
+        # Parents before children, as the fields are listed
+        stack = [self]
+        while len(stack) > 0:
+            t = stack.pop()
+            edges = [0]*3
+            for i in range(3):
+                p = t.verts[i-1]
+                q = t.verts[i-2]
+                # The graph should have been completed by now, so the link p,q exists
+                edges[i] = links.find(p,q)
+                if edges[i] is None:
+                    print 'a does NOT have edge',p,q
+                    print 'there is a programming error'
+                    print 'a only has the edges:'
+                    for p,q in links.edges():
+                        print p,q
+                    print 'a has %s 1st gen triangles:'%len(self.a.triangulation)
+                    for first in self.a.triangulation:
+                        print first.verts
+
+            # The link that completes this triangle
+            last = max(edges,key=order.__getitem__)
+            links.addField(last,t.verts)
+
+            stack.extend(t.children[::-1])
 
     def edgesByDepth(self,depth):
         # Return list of edges of triangles at given depth
@@ -260,12 +331,12 @@ class Triangle:
         # etc.
         if depth == 0:
             return [ (self.verts[i],self.verts[i-1]) for i in range(3) ]
-        if depth == 1:
-            if self.center is None:
-                return []
-            return [ (self.verts[i],self.center) for i in range(3) ]
-        return [e for child in self.children\
-                  for e in child.edgesByDepth(depth-1)]
+        # The triangles depth-1 generations down (in the order of the recursive definition)
+        level = [self]
+        for i in xrange(depth-1):
+            level = [child for t in level for child in t.children]
+        return [ (t.verts[i],t.center) for t in level if t.center is not None\
+                                       for i in range(3) ]
 
 
 
@@ -34,6 +34,11 @@ COMMTIME = 60
 # Seconds to create a link
 LINKTIME = 15
 
+# Let improveEdgeOrder move a link from a new origin next to the links from the nearest earlier origin
+MOVE_TO_NEAREST = True
+# The number of nearest portals improveEdgeOrder checks for being earlier origins
+NEAREST_CANDIDATES = 8
+
 ## DEPRECIATED ##
 def getGreedyAgentOrder_DONT_USE_THIS_FUNCTION(a,nagents,orderedEdges):
     '''
@@ -71,7 +76,7 @@ def getGreedyAgentOrder_DONT_USE_THIS_FUNCTION(a,nagents,orderedEdges):
             movements[assigning].append(e)
             starts[p] = assigning
             
-            agentpos[assigning] = a.node[p]['geo']
+            agentpos[assigning] = a.portals.geo[p]
 
             assigning += 1
             if assigning >= nagents:
@@ -85,7 +90,7 @@ def getGreedyAgentOrder_DONT_USE_THIS_FUNCTION(a,nagents,orderedEdges):
     # continue from startup loop
     for e in xrange(e+1,m):
         p,q = orderedEdges[e]
-        ppos = a.node[p]['geo']
+        ppos = a.portals.geo[p]
 
         dists = geometry.sphereDist(agentpos,ppos)
         radii = curtime-lastActTime # how far could they have moved
@@ -162,10 +167,54 @@ def expandOrder(s,mult):
 
     return order
 
-def getAgentOrder(a,nagents,orderedEdges):
+def getOrderedEdges(a):
+    # if the ith link to be made is (p,q) then orderedEdges[i] = (p,q)
+    return a.links.edges()
+
+def originVisits(a,orderedEdges):
+    '''
+    The part of getAgentOrder that does not depend on the number of agents
+    returns d,condensed,mult
+        condensed,mult is the condensed sequence of link origins (see condenseOrder)
+        d gives the distances between link origins
+    '''
+    geo = a.portals.geo
+    order = [e[0] for e in orderedEdges]
+
+    # Reduce sequences of links made from same portal to single entry
+    condensed , mult = condenseOrder(order)
+
+    # Agents only walk between link origins
+    d = geometry.LazyDists(geo,condensed)
+
+    return d,condensed,mult
+
+def agentVisits(nagents,d,condensed,mult,timeBudget=None,verbose=True):
+    '''
+    d,condensed,mult: the output of originVisits
+    returns link2agent,walkdist
+        link2agent[i] is the agent who makes link i
+        walkdist is the number of meters walked before the last link can be made
+    '''
+    link2agent , times = orderedTSP.getVisits(d,condensed,nagents,timeBudget,verbose)
+
+    # Expand links made from same portal to original count
+    link2agent = expandOrder(link2agent,mult)
+
+    return link2agent,times[-1]
+
+def sweepVisits(job):
+    # agentVisits for a process pool: job is a tuple of its arguments
+    return agentVisits(*job)
+
+def getAgentOrder(a,nagents,orderedEdges,timeBudget=None,assignment=None):
     '''
     returns visits
     visits[i] = j means agent j should make edge i
+
+    timeBudget: seconds allowed for searching for the assignment (see orderedTSP.getVisits)
+    assignment: if given, the output of agentVisits for this plan and nagents
+        (no search is done)
     
     ALSO creates time attributes in a:
         
@@ -176,18 +225,11 @@ def getAgentOrder(a,nagents,orderedEdges):
     Time spent navigating linking menu
         a.linktime
     '''
-    geo = np.array([ a.node[i]['geo'] for i in xrange(a.order())])
-    d = geometry.sphereDist(geo,geo)
-#    print d
-    order = [e[0] for e in orderedEdges]
+    if assignment is None:
+        d,condensed,mult = originVisits(a,orderedEdges)
+        assignment = agentVisits(nagents,d,condensed,mult,timeBudget)
 
-    # Reduce sequences of links made from same portal to single entry
-    condensed , mult = condenseOrder(order)
-
-    link2agent , times = orderedTSP.getVisits(d,condensed,nagents)
-
-    # Expand links made from same portal to original count
-    link2agent = expandOrder(link2agent,mult)
+    link2agent , walkdist = assignment
 
     # If agents communicate sequential completions all at once, we avoid waiting for multiple messages
     # To find out how many communications will be sent, we count the number of same-agent link sequences
@@ -195,60 +237,20 @@ def getAgentOrder(a,nagents,orderedEdges):
     numCOMMs = len(condensed)
 
     # Time that must be spent just walking
-    a.walktime = times[-1]/WALKSPEED
+    a.walktime = walkdist/WALKSPEED
     # Waiting for link completion messages to be sent
     a.commtime = numCOMMs*COMMTIME
     # Time spent navigating linking menu
-    a.linktime = a.size()*LINKTIME
+    a.linktime = len(a.links)*LINKTIME
 
-    movements = [None]*nagents
+    # Some agents may not be needed
+    movements = [ [] for i in xrange(nagents) ]
 
     for i in xrange(len(link2agent)):
-        try:    
-            movements[link2agent[i]].append(i)
-        except:
-            movements[link2agent[i]] = [i]
+        movements[link2agent[i]].append(i)
 
     return movements
 
-#    m = a.size()
-#
-#    # link2agent[j] is the agent who makes link j
-#    link2agent = [-1]*m
-#    for i in range(nagents):
-#        for j in movements[i]:
-#            link2agent[j] = i
-#
-#    bestT = completionTime(a,movements)
-#
-#    sinceImprove = 0
-#    i=0
-#    while sinceImprove < m:
-#        agent = link2agent[i]
-#        
-#        # for each of the other agents
-#        for alt in range(agent-nagents+1,agent):
-#
-#            alt %= nagents
-#            # see what happens if agent 'alt' makes the link
-#            link2agent[i] = alt
-#
-#            T = completionTime(a,link2agent)
-#
-#            if T < bestT:
-#                bestT = T
-#                sinceImprove = 0
-#                break
-#        else:
-#            # The loop exited normally, so no improvement was found
-#            link2agent[i] = agent # restore the original plan
-#            sinceImprove += 1
-#
-#        i = (i+1)%m
-#
-#    return movements
-#
-#
 def improveEdgeOrder(a):
     '''
     Edges that do not complete any fields can be made earlier
@@ -256,43 +258,86 @@ def improveEdgeOrder(a):
         The relative order of edges that complete fields is unchanged
         Edges that do not complete fields may only be completed earlier
         Where possible, non-completing edges are made immediately before another edge with same origin
-    '''
-    m = a.size()
-    # If link i is e then orderedEdges[i]=e
-    orderedEdges = [-1]*m
+        Otherwise (with MOVE_TO_NEAREST), a non-completing edge from a new origin is made
+            immediately before the edges from the nearest earlier origin,
+            if that is nearer than the origin of the edge before it
 
-    for p,q in a.edges_iter():
-        orderedEdges[a.edge[p][q]['order']] = (p,q)
-
-    for j in xrange(1,m):
-        p,q = orderedEdges[j]
-        # Only move those that don't complete fields
-        if len(a.edge[p][q]['fields']) > 0:
+    Takes O(m) time (plus a grid search for NEAREST_CANDIDATES neighbors of each new origin that may move)
+    '''
+    links = a.links
+    m = len(links)
+    if m == 0:
+        return
+    # If the ith link to be made is e then orderedLinks[i]=e (an index of a.links)
+    orderedLinks = links.byOrder().tolist()
+
+    origins = links.origin.tolist()
+    numfields = links.fieldCounts()
+
+    # For finding candidates for the nearest earlier origin of each portal
+    if MOVE_TO_NEAREST:
+        xy = a.portals.xy
+        index = a.portals.index()
+
+    # anchor[p] is the first link from p that stays in place
+    #     links from p that move are made just before it (the last one moved first)
+    #     as are the groups of links that move to be near p (in the order they moved)
+    anchor = {}
+    moved = {}
+    attached = {}
+    # The links that stay in place, in order
+    kept = []
+
+    for e in orderedLinks:
+        p = origins[e]
+        if p in anchor:
+            if numfields[e] == 0:
+                # Move link e to be just before the first one from p
+                moved[anchor[p]].append(e)
+            else:
+                kept.append(e)
             continue
 
-#        print j,p,q,a.edge[p][q]['fields']
-
-        origin = orderedEdges[j][0]
-        # The first time this portal is used as an origin
-        i = 0
-        while orderedEdges[i][0]!=origin:
-            i+=1
-
-        if i<j:
-#            print 'moving %s before %s'%(orderedEdges[j],orderedEdges[i])
-            # Move link j to be just before link i
-            orderedEdges =  orderedEdges[   :i] +\
-                           [orderedEdges[  j  ]]+\
-                            orderedEdges[i  :j] +\
-                            orderedEdges[j+1: ]
-        #TODO else: choose the closest earlier portal
-    
-#    print 
-    for i in xrange(m):
-        p,q = orderedEdges[i]
-#        print p,q,a.edge[p][q]['fields']
-        a.edge[p][q]['order'] = i
-#    print
+        anchor[p] = e
+        moved[e] = []
+        attached[e] = []
+
+        if MOVE_TO_NEAREST and numfields[e] == 0 and len(kept) > 0:
+            # Look for the nearest portal that is already an origin
+            last = origins[kept[-1]]
+            lastDist = np.sqrt(np.sum((xy[p]-xy[last])**2))
+            target = None
+            nearDists,nearInds = index.nearest(xy[p],NEAREST_CANDIDATES+1)
+            for d,q in zip(nearDists.tolist(),nearInds.tolist()):
+                if d >= lastDist:
+                    break
+                if q != p and q in anchor:
+                    target = q
+                    break
+            if target is not None:
+                # Move link e (and the links that will be moved before it) to be near target
+                attached[anchor[target]].append(e)
+                continue
+
+        kept.append(e)
+
+    # Every group is written as: attached groups, moved links, anchor
+    orderedLinks = []
+    stack = kept[::-1]
+    while len(stack) > 0:
+        e = stack.pop()
+        if e < 0:
+            # The attached groups of anchor ~e are done
+            e = ~e
+            orderedLinks.extend(moved[e][::-1])
+            orderedLinks.append(e)
+        elif e in attached:
+            stack.append(~e)
+            stack.extend(attached[e][::-1])
+        else:
+            orderedLinks.append(e)
+
+    links.reorder(orderedLinks)
 
 if __name__=='__main__':
     order = [0,5,5,5,2,2,1,0]
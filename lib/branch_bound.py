@@ -20,6 +20,7 @@ You should have received a copy of the GNU General Public License
 along with Maxfield.  If not, see <http://www.gnu.org/licenses/>.
 '''
 import numpy as np
+import time
 
 class CantSplit(Exception):
     pass
@@ -31,6 +32,38 @@ class InfState:
     def split(self,num):
         raise CantSplit()
 
+def lowest(values,lo):
+    '''
+    returns the (unsorted) indices of the lo smallest members of values
+        values may have any shape, returned indices are into values.reshape(-1)
+    '''
+    values = np.asarray(values).reshape(-1)
+    if len(values) <= lo:
+        return np.arange(len(values))
+    # Partial sort: survivors don't need to be ordered among themselves
+    return np.argpartition(values,lo-1)[:lo]
+
+def adaptWidth(width,elapsed,deadline,levels,lo):
+    '''
+    Chooses the number of branches for the next levels of a search
+        assuming time per level is proportional to the number of branches
+
+    width: the number of branches used for the last level
+    elapsed: the seconds it took
+    deadline: the time.time() by which the remaining levels levels should be finished
+    lo: the most branches ever explored
+
+    returns the new number of branches (at least 1)
+    '''
+    left = deadline - time.time()
+    if left <= 0 or levels <= 0:
+        return 1
+    if elapsed <= 0:
+        return lo
+    # Seconds per branch per level
+    rate = elapsed / width
+    return int(max(1,min(lo, left/levels/rate )))
+
 def branch_bound(root,lo,hi,callback=None):
     '''
     Uses a branch-and-bound style approach to minimize a function
@@ -82,3 +115,48 @@ def branch_bound(root,lo,hi,callback=None):
 #    print finals[-1].value
     return finals[best],finals[best].value
 
+def batch_branch_bound(states,lo,callback=None,deadline=None):
+    '''
+    The same search as branch_bound for a container that holds a whole level of states
+        Children are never created as objects unless they survive the cut
+
+    lo: number of branches to explore further
+    callback: function called at the beginning of every iteration
+    deadline: if given, the time.time() by which the search should be finished
+        the number of branches explored shrinks (never above lo) to meet it
+        once it has passed, only the best branch is explored
+        states must then also have remaining() returning the number of levels left
+
+    states: a container with
+        childValues(num) returning an array of values of all children of all states
+            num is the number of children that will be kept
+            raising CantSplit if the states are final
+            children with infinite value are never kept
+        advance(values,keep) replacing its states with the children at flat indices keep
+        value an array of the values of its states
+
+    returns states,b,v
+        states is the container (now holding the final states)
+        b is the index of the best final state, v is its value
+    '''
+    if callback == None:
+        def callback():
+            pass
+
+    width = lo
+    while True:
+        callback()
+        start = time.time()
+        try:
+            values = states.childValues(width)
+        except CantSplit:
+            break
+        keep = lowest(values,width)
+        keep = keep[np.isfinite(values.reshape(-1)[keep])]
+        states.advance(values,keep)
+
+        if deadline is not None:
+            width = adaptWidth(width,time.time()-start,deadline,states.remaining(),lo)
+
+    best = np.argmin(states.value)
+    return states,best,states.value[best]
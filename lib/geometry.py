@@ -22,7 +22,15 @@ along with Maxfield.  If not, see <http://www.gnu.org/licenses/>.
 # Portals, triangles and the like
 
 import numpy as np
-from itertools import combinations
+
+# commonHemisphere gives up after this many iterations
+HEMISPHERE_ITERATIONS = 1000
+# commonHemisphere stops when its center is this close (relatively) to the best one
+# or when the origin is this close to the convex hull of the points
+HEMISPHERE_TOLERANCE = 1e-6
+
+# greatArcAng and planeDist(k=...) compute about this many distances at a time
+DIST_BLOCK = 1<<16
 
 def LLtoRads(pts):
     pts = pts.astype(float)
@@ -61,10 +69,16 @@ def xyztorads(pts,R=1):
 
     return np.column_stack([lat,lng])
 
-def greatArcAng(x,y):
+def greatArcAng(x,y,out=None,dtype=float):
     '''
     x,y should be nx2 arrays expressing latitude,longitude (in radians)
     Great arc angle between x and y (in radians)
+        angles[i,j] is the angle between y[i] and x[j]
+
+    out is an optional ny x nx array (e.g. a np.memmap) to write the angles into
+    dtype is the type of the angles when out is not given (np.float32 takes half the memory)
+
+    Only a few rows are computed at a time, so the result is the only large array
     '''
 
     # If either is a single point (not in a list) return a 1-d array
@@ -77,75 +91,285 @@ def greatArcAng(x,y):
     nx = x.shape[0]
     ny = y.shape[0]
 
-    # After reshaping, arithmetic operators produce distance-style matrices
-    latx = np.tile(x[:,0],[ny,1])
-    lngx = np.tile(x[:,1],[ny,1])
-    laty = np.tile(y[:,0],[nx,1]).T
-    lngy = np.tile(y[:,1],[nx,1]).T
+    if out is None:
+        out = np.empty([ny,nx],dtype=dtype)
 
-    dlng = np.abs(lngx-lngy)
+    # Rows and columns of a block make distance-style matrices
+    sinx = np.sin(x[:,0])
+    cosx = np.cos(x[:,0])
+    lngx = x[:,1]
 
-    sinx = np.sin(latx)
-    cosx = np.cos(latx)
+    siny = np.sin(y[:,0]).reshape([-1,1])
+    cosy = np.cos(y[:,0]).reshape([-1,1])
+    lngy = y[:,1].reshape([-1,1])
 
-    siny = np.sin(laty)
-    cosy = np.cos(laty)
-    
-    sind = np.sin(dlng)
-    cosd = np.cos(dlng)
+    step = max(DIST_BLOCK//max(nx,1),1)
+    for s in xrange(0,ny,step):
+        e = s+step
+
+        dlng = np.abs(lngx-lngy[s:e])
+
+        sind = np.sin(dlng)
+        cosd = np.cos(dlng)
 
-    numer = np.sqrt( (cosx*sind)**2 + (cosy*sinx-siny*cosx*cosd)**2 )
-    denom = siny*sinx + cosy*cosx*cosd
+        numer = np.sqrt( (cosx*sind)**2 + (cosy[s:e]*sinx-siny[s:e]*cosx*cosd)**2 )
+        denom = siny[s:e]*sinx + cosy[s:e]*cosx*cosd
 
-    # great arc angle containing x and y
-    angles = np.arctan2(numer,denom)
+        # great arc angle containing x and y
+        out[s:e] = np.arctan2(numer,denom)
 
     if flatten:
-        angles.shape = -1
+        return out.reshape(-1)
 
-    return angles
+    return out
 
-def sphereDist(x,y,R=6371000):
+def sphereDist(x,y,R=6371000,out=None,dtype=float):
     '''
     x,y are n x 2 arrays with lattitude, longitude in radians
+    out and dtype are as in greatArcAng
     '''
-    sigma = greatArcAng(x,y)
-    return R*sigma
+    sigma = greatArcAng(x,y,out,dtype)
+    sigma *= R
+    return sigma
+
+class LazyDists:
+    def __init__(self,x,cols=None,R=6371000):
+        '''
+        Stands in for the distance matrix sphereDist(x,x) when only some of it is read
+            d[i,j] is the distance between x[i] and x[j]
+        Row i is computed (and kept) the first time it is read
+
+        x:    n x 2 array with lattitude, longitude in radians
+        cols: indices of the only points that will be used as j
+            rows then only hold distances to these points
+            reading any other j raises an IndexError
+        j may also be -1, standing for no point (e.g. an agent that has not been anywhere)
+            its distance is 0
+        '''
+        n = x.shape[0]
+        self.shape = (n,n)
+        self.x = x
+        self.R = R
+
+        if cols is None:
+            cols = np.arange(n)
+        self.cols = np.unique(cols)
+
+        # colinds[j] is the position of j in self.cols (-1 if j is not one of them)
+        # colinds[-1] is the position of the 0 at the end of each row
+        self.colinds = -np.ones(n+1,dtype=int)
+        self.colinds[self.cols] = np.arange(len(self.cols))
+        self.colinds[-1] = len(self.cols)
+
+        self.rows = [None]*n
+
+    def row(self,i):
+        r = self.rows[i]
+        if r is None:
+            r = np.append(sphereDist(self.x[self.cols],self.x[i],self.R),0)
+            self.rows[i] = r
+        return r
+
+    def __getitem__(self,ij):
+        # j may be an integer or an array of integers
+        i,j = ij
+        inds = self.colinds[j]
+        if np.any(inds < 0):
+            raise IndexError('LazyDists has no distances to these points')
+        return self.row(i)[inds]
+
+class GridIndex:
+    def __init__(self,xy):
+        '''
+        Sorts planar points into the cells of a square grid for quick rectangle queries
+        xy: n x 2 array of points (e.g. a gnomonic projection)
+        '''
+        n = xy.shape[0]
+        self.xy = xy
+
+        self.lo = xy.min(0)
+        span = xy.max(0) - self.lo
+        # Roughly one point per cell if they are spread evenly
+        self.cellsize = max(span.max()/np.sqrt(n),1e-12)
+        self.shape = (span//self.cellsize).astype(int) + 1
+
+        flat = self.flatCell(self.cell(xy))
+        # Points sorted by cell, starts[c] is where cell c begins
+        self.bycell = np.argsort(flat,kind='mergesort')
+        self.starts = np.searchsorted(flat[self.bycell],np.arange(self.shape.prod()+1))
+
+    def cell(self,xy):
+        # Row and column of the cell containing each point (clipped to the grid)
+        c = ((xy-self.lo)//self.cellsize).astype(int)
+        return np.clip(c,0,self.shape-1)
+
+    def flatCell(self,c):
+        return c[...,0]*self.shape[1] + c[...,1]
+
+    def query(self,lo,hi):
+        '''
+        returns the indices (ascending) of the points with lo <= xy <= hi
+        '''
+        found = self.inCells(self.cell(lo),self.cell(hi))
+        inbox = np.all((self.xy[found] >= lo) & (self.xy[found] <= hi),1)
+        return found[inbox]
+
+    def inCells(self,c0,c1):
+        # Indices (ascending) of the points in the cells from c0 to c1 (corners of a block)
+        # The cells of each grid row are contiguous in bycell
+        found = [ self.bycell[self.starts[self.flatCell(np.array([i,c0[1]]))]:\
+                              self.starts[self.flatCell(np.array([i,c1[1]]))+1]]\
+                  for i in xrange(c0[0],c1[0]+1) ]
+        return np.sort(np.concatenate(found))
+
+    def nearest(self,x,k):
+        '''
+        x is a point (length 2 array)
+        returns (d,inds) like planeDist(x,self.xy,k)[0]
+            inds are the indices of the k points closest to x, nearest first
+            d are their distances
+        Looks in ever larger blocks of cells around x, so it takes about O(k) time
+        '''
+        k = min(k,self.xy.shape[0])
+        c = self.cell(x)
+        # Points outside the block of cells within r of c are at least edge + r*cellsize from x
+        offset = x - self.lo - c*self.cellsize
+        edge = max(min(offset.min(),self.cellsize-offset.max()),0)
+        r = 0
+        while True:
+            c0 = np.maximum(c-r,0)
+            c1 = np.minimum(c+r,self.shape-1)
+            found = self.inCells(c0,c1)
+            whole = np.all(c0 == 0) and np.all(c1 == self.shape-1)
+            if len(found) >= k:
+                dist = np.sqrt(np.sum((self.xy[found]-x)**2,1))
+                near = np.argsort(dist,kind='mergesort')[:k]
+                if whole or dist[near[-1]] <= edge+r*self.cellsize:
+                    return dist[near],found[near]
+            r += 1
+
+def sphereTriNormals(pts):
+    '''
+    pts is a 3 x 3 array representing vertices of a triangle (xyz format)
+
+    returns normals (3 x 3)
+        normals[i] is orthogonal to the plane through the origin and the side opposite vertex i
+        and points to the side of that plane where vertex i is
+    '''
+    # Find vectors orthogonal to the planes through origin and triangle sides
+    crosses = np.cross( pts[[1,2,0]] , pts[[2,0,1]] )
+    psign = np.sum(crosses*pts,1).reshape([3,1])
+    return crosses*np.sign(psign)
 
 def sphereTriContains(pts,x):
     '''
     pts is a 3 x 3 array representing vertices of a triangle
         pts[i] contains the x,y,z coords of vertex i
-    x is a 2-array representing the test point
+    x is a 3-array representing the test point (or an n x 3 array of them)
 
     points should be represented in xyz format
 
-    returns True iff x is inside the triangle
+    returns True iff x is inside the triangle (an n-array for n points)
         yes, three points make two triangles, but we assume the small one
 
     behavior in border cases ont guaranteed
     '''
     x = x.reshape([-1,3])
-
-    # Find vectors orthogonal to the planes through origin and triangle sides
-
-    crosses = np.cross( pts[[1,2,0]] , pts[[2,0,1]] )
-
-    xsign = np.dot( crosses,x.T )
-    psign = np.sum(crosses*pts,1).reshape([3,1])
+    normals = sphereTriNormals(pts)
 
     # Check whether opposite vertex is always on same side of plane as x
-    return np.all( xsign*psign > 0,0)
+    return np.all( np.dot(normals,x.T) > 0,0)
 
-def planeDist(x,y=None):
+def sphereTriSplit(pts,p,x):
+    '''
+    pts is a 3 x 3 array representing vertices of a triangle (xyz format)
+    p is a point inside the triangle, splitting it into the three triangles
+        0: p,pts[1],pts[2]
+        1: pts[0],pts[2],p
+        2: pts[0],pts[1],p
+    x is an n x 3 array of points inside the triangle (not including p)
+
+    returns which (an n-array)
+        which[j] is the triangle containing x[j] (-1 if x[j] is on a border)
+    '''
+    # The new sides all go through p
+    # planes[i] is orthogonal to the plane through the origin, p and pts[i]
+    planes = np.cross(p,pts)
+    # xsides[j,i] and psides[k,i] tell the sides of plane i that x[j] and pts[k] are on
+    xsides = np.dot(x,planes.T)
+    psides = np.dot(pts,planes.T)
+
+    # Each smaller triangle has two new sides
+    # x[j] is inside if it is on the same side as the opposite vertex for both
+    which = -np.ones(x.shape[0],dtype=int)
+    which[ (xsides[:,1]*psides[2,1] > 0) & (xsides[:,2]*psides[1,2] > 0) ] = 0
+    which[ (xsides[:,0]*psides[2,0] > 0) & (xsides[:,2]*psides[0,2] > 0) ] = 1
+    which[ (xsides[:,0]*psides[1,0] > 0) & (xsides[:,1]*psides[0,1] > 0) ] = 2
+
+    return which
+
+def planeDist(x,y=None,k=None):
+    '''
+    x,y are n x 2 and m x 2 arrays of planar points (y is x by default)
+    returns d (n x m)
+        d[i,j] is the distance between x[i] and y[j]
+
+    if k is given, returns (d,inds) (both n x k) instead
+        inds[i] are the indices of the k points of y closest to x[i], nearest first
+        d[i] are their distances
+        (when y is x, x[i] itself is first)
+    '''
     x = x.reshape([-1,2])
     if y is None:
         y = x
     else:
         y = y.reshape([-1,2])
 
-    #TODO this is not a clever way of makeing the matrix
-    return np.sqrt(np.array([ [sum( (a-b)**2 ) for a in y] for b in x ]))
+    if k is None:
+        return np.sqrt(np.sum((y-x[:,np.newaxis])**2,2))
+
+    n = x.shape[0]
+    k = min(k,y.shape[0])
+    d    = np.empty([n,k])
+    inds = np.empty([n,k],dtype=int)
+
+    # A few rows at a time, so the whole matrix is never made
+    step = max(DIST_BLOCK//max(y.shape[0],1),1)
+    for s in xrange(0,n,step):
+        e = min(s+step,n)
+        block = np.sum((y-x[s:e,np.newaxis])**2,2)
+        near = np.argpartition(block,k-1,1)[:,:k]
+        rows = np.arange(e-s).reshape([-1,1])
+        near = near[rows,np.argsort(block[rows,near],1)]
+        inds[s:e] = near
+        d[s:e] = np.sqrt(block[rows,near])
+
+    return d,inds
+
+def benchPlaneDist(sizes=(100,1000,5000)):
+    '''
+    Prints times for planeDist and the nested loops it replaced
+    '''
+    import time
+
+    def loops(x,y):
+        return np.sqrt(np.array([ [sum( (a-b)**2 ) for a in y] for b in x ]))
+
+    print '%6s %12s %12s %12s'%('points','loops (s)','planeDist','k=8')
+    for n in sizes:
+        x = np.random.rand(n,2)
+
+        t0 = time.time()
+        old = loops(x,x)
+        t1 = time.time()
+        new = planeDist(x)
+        t2 = time.time()
+        planeDist(x,k=8)
+        t3 = time.time()
+
+        if not np.array_equal(old,new):
+            print 'planeDist disagrees with the loops'
+        print '%6d %12.4f %12.4f %12.4f'%(n,t1-t0,t2-t1,t3-t2)
 
 def makeLace(n):
     # sequence of perimeter nodes to hit for a lacing-style triangulation
@@ -170,18 +394,22 @@ def norms(x):
     'Norm per row of x'
     return np.sqrt(np.sum(x**2,1))
 
-def gnomonicProj(pts,ptsxyz=None):
+def gnomonicProj(pts,ptsxyz=None,center=None):
     '''
     pts should be in lat/lng
-    Uses the centroid of pts as the center, North Pole as positive y-direction
-    This is only guaranteed to work if no two points are more than 90 degrees apart (great arcwise)
+    Uses center (xyz, the centroid of pts by default) as the center, North Pole as positive y-direction
+    This only works if all points are less than 90 degrees from the center (great arcwise)
     This is about 9700 km across the surface of Earth
+        commonHemisphere finds a center if there is one
     '''
     if ptsxyz is None:
         ptsxyz = radstoxyz(pts)
 
     # We'll project onto the plane tangent at base
-    basexyz = ptsxyz.mean(0)
+    if center is None:
+        basexyz = ptsxyz.mean(0)
+    else:
+        basexyz = np.array(center,dtype=float)
     basexyz /= np.linalg.norm(basexyz)
 
     base = xyztorads(basexyz).reshape(-1)
@@ -212,59 +440,78 @@ def gnomonicProj(pts,ptsxyz=None):
     xy = np.column_stack([ -np.sin(theta) , np.cos(theta) ])*r
     return xy
 
-def between(a,b,pts):
-    # For use with gerperim
-    # Returns the index of a point in pts "left" of the ray a-b
-
-    # diff will be orthogonal to the line through a,b
-    diff = pts[a]-pts[b]
-    rotate(diff)
-    
-    # maximum inner product with diff
-    c = np.argmax(np.dot(pts,diff))
+def interiorMask(pts,poly):
+    '''
+    For use with getPerim
+    poly is an array of indices of pts making a convex polygon (counter-clockwise)
 
-    if c == a or c == b:
-        return None
-    else:
-        return c
+    returns a boolean array telling which points are strictly inside poly
+    '''
+    inside = np.ones(pts.shape[0],dtype=bool)
+    for i in range(len(poly)):
+        u = pts[poly[i-1]]
+        v = pts[poly[i]]
+        # cross product of v-u and pts-u
+        inside &= (v[0]-u[0])*(pts[:,1]-u[1]) - (v[1]-u[1])*(pts[:,0]-u[0]) > 0
+    return inside
 
 def getPerim(pts):
     '''
     Returns a list of indices of the points on the "outside" (in the boundary of the convex hull)
+    The list goes counter-clockwise, starting with the point with the greatest x-coordinate
+
+    Points in the middle of a side of the hull are left out
+    Of several points at the same location, only the one with the lowest index is used
    
     This is for planar points (spherical points should be get Gnomonic projection first)
     '''
-    # Point with the greatest x-coordinate is certainly outside
-    hix = np.argmax(pts[:,0])
-    # Same goes for the point with the least x-coordinate
-    lox = np.argmin(pts[:,0])
-
-    perim = {hix:lox , lox:hix}
-    perimlist = []
-
-    a = hix
-    b = lox
-    
-    aNeverChanged = True
-
-    while a != hix or aNeverChanged:
-        c = between(a,b,pts)
-        if c is None:
-            # there is no perimeter point between a and b
-            # proceed to the next adjacent pair
-            perimlist.append(a)
-            a = b
-            b = perim[b]
-
-            aNeverChanged = False
-        else:
-            # c is on the perimeter after a
-            # we will next look for another point between a,c
-            perim[a] = c
-            perim[c] = b
-            b = c
-
-    return perimlist
+    x = pts[:,0]
+    y = pts[:,1]
+    candidates = np.arange(pts.shape[0])
+
+    # Points inside the polygon of extreme points can't be on the perimeter
+    # (this usually leaves very few points for the sort and loops below)
+    poly = [np.argmax(x),np.argmax(x+y),np.argmax(y),np.argmax(y-x),\
+            np.argmin(x),np.argmin(x+y),np.argmin(y),np.argmax(x-y)]
+    poly = [p for i,p in enumerate(poly) if np.any(pts[p] != pts[poly[i-1]])]
+    if len(poly) >= 3:
+        candidates = candidates[~interiorMask(pts,poly)]
+
+    # Sorted by x, then y, then index
+    order = candidates[np.lexsort((candidates,y[candidates],x[candidates]))]
+    spts = pts[order]
+    distinct = np.ones(len(order),dtype=bool)
+    distinct[1:] = np.any(spts[1:] != spts[:-1],1)
+    order = order[distinct]
+
+    if len(order) < 3:
+        return order[::-1].tolist()
+
+    xs = pts[:,0].tolist()
+    ys = pts[:,1].tolist()
+
+    def chain(idx):
+        # Monotone chain, turning left at every point
+        hull = []
+        for c in idx:
+            while len(hull) >= 2:
+                a,b = hull[-2],hull[-1]
+                if (xs[b]-xs[a])*(ys[c]-ys[a]) - (ys[b]-ys[a])*(xs[c]-xs[a]) > 0:
+                    break
+                hull.pop()
+            hull.append(c)
+        return hull
+
+    order = order.tolist()
+    lower = chain(order)
+    upper = chain(order[::-1])
+    perimlist = lower[:-1]+upper[:-1]
+
+    # The first point with greatest x-coordinate comes at the end of the lower chain
+    start = len(lower)-1
+    while start > 0 and xs[perimlist[start-1]] == xs[perimlist[start]]:
+        start -= 1
+    return perimlist[start:]+perimlist[:start]
 
 def arc(a,b,c):
     '''
@@ -339,53 +586,68 @@ def commonHemisphere(xyz,getDisproof=False):
     xyz should be an n x 3 numpy array with point coordinates
     if it exists, returns (p,None)
         p is a 3-vector such that all( np.dot(xyz,p) > 0 )
-        p is orthogonal to the plane through the points indexed by inds
+        p is the centroid of xyz if that works
+        otherwise, p is (nearly) the center of the smallest spherical cap containing the points
     otherwise, returns (None,inds)
-        inds are the indices of 4 non-co-hemispherical points
-        inds are None if getDisproof is False (since these take extra time to compute with this implementation)
+        inds are indices of points whose convex hull (nearly) contains the origin
+        inds are None if getDisproof is False
+    returns (None,None) if HEMISPHERE_ITERATIONS iterations neither found p nor ruled it out
+        (this only happens for points that very nearly fill a hemisphere)
 
     the plane through the origin and orthogonal to p has all points of xyz on the same side
     this defines a hemisphere appropriate for gnomic projection
+
+    p is found with Gilbert's algorithm for the point of the convex hull of xyz closest to the origin
+    each iteration takes O(n) time
     '''
     n = xyz.shape[0]
-    if n < 4:
-        if n == 0:
-            return (np.array([1,0,0]),None)
-        if n == 1:
-            return (xyz,None)
-        if n == 2:
-            return (np.mean(xyz,0),None)
-        if n == 3:
-            return (orthplane(xyz),None)
-
-    for tri in combinations(xyz,3):
-        p = orthplane(tri)
+    if n == 0:
+        return (np.array([1.,0,0]),None)
+
+    # This almost always works
+    p = xyz.mean(0)
+    if np.all(np.dot(xyz,p) > 0):
+        return (p,None)
+
+    # p is kept as a convex combination of the points
+    weights = np.zeros(n)
+    i = np.argmax(np.dot(xyz,p))
+    weights[i] = 1
+    p = xyz[i].copy()
+
+    for _ in xrange(HEMISPHERE_ITERATIONS):
+        pp = np.dot(p,p)
+        if pp < HEMISPHERE_TOLERANCE**2:
+            # The origin is in the convex hull
+            break
+        dots = np.dot(xyz,p)
+        i = np.argmin(dots)
+        if dots[i] > 0 and pp-dots[i] < HEMISPHERE_TOLERANCE*pp:
+            # p is close enough to the closest point
+            return (p,None)
+        # Move toward xyz[i] as far as it brings p closer to the origin
+        step = p-xyz[i]
+        t = min(1.,(pp-dots[i])/np.dot(step,step))
+        p -= t*step
+        weights *= 1-t
+        weights[i] += t
+    else:
         if np.all(np.dot(xyz,p) > 0):
-            print np.dot(xyz,p)
             return (p,None)
+        # Running out of iterations proves nothing
+        return (None,None)
 
     if not getDisproof:
         return (None,None)
-
-    range1_4 = range(1,4)
-    range4 = range(4)
-
-    for quad in combinations(range(n),4):
-        for j in range4:
-            noj = [ quad[j-i] for i in range1_4 ]
-            p = orthplane(xyz[noj])
-            if np.dot(xyz[quad[j]],p) > 0:
-                # The convex hull of these four don't contain the origin
-                break
-        else:
-            # The loop exited normally
-            # The current quad is a counter example
-            return (None,quad)
-
-    print xyz
-    print "We shouldn't be here"
+    return (None,np.nonzero(weights)[0])
 
 if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ['bench']:
+        # python geometry.py bench
+        benchPlaneDist()
+        sys.exit()
+
     # Test common hemisphere finder
 
     import matplotlib.pyplot as plt
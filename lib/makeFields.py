@@ -23,6 +23,8 @@ along with Maxfield.  If not, see <http://www.gnu.org/licenses/>.
 import geometry
 np = geometry.np
 from Triangle import Triangle,Deadend
+import LinkTable
+from multiprocessing import Pool
 
 '''
 Some things are chosen randomly:
@@ -32,98 +34,221 @@ This is the number of times to randomly rebuild each first generation triangle w
 '''
 TRIES_PER_TRI = 1
 
-def canFlip(degrees,keylacks,p,q):
-    '''
-    True iff reversing edge p,q is a paraeto improvement
-        out-degree of q must be <8
-        p must have a key surplus
-    '''
-    return (degrees[q,1] < 8) & (keylacks[p]<0)
-
-def flip(a,p,q,degrees=None,keylacks=None):
-    if not a.edge[p][q]['reversible']:
-        print '!!!! Trying to reverse a non-reversible edge !!!!'
-        print p,q
-    # Give the reversed edge the same properties
-    a.add_edge(q,p,a.edge[p][q])
-    a.remove_edge(p,q)
-    if degrees != None:
-        degrees[p,0] += 1
-        degrees[p,1] -= 1
-        degrees[q,0] -= 1
-        degrees[q,1] += 1
-
-    if keylacks != None:
-        keylacks[p] += 1
-        keylacks[q] -= 1
-
-def flipSome(a):
-    '''
-    Tries to make each in and out degree of a <=8 by reversing edges
-    Only edges with the property reversible=True will be flipped
-    Secondarily, tries to reduce the number of keys that need to be farmed
-    '''
-    n = a.order()
-    degrees  = np.empty([n,2],dtype=int)
-    keylacks = np.empty(n,dtype=int) # negative if there's a surplus
-
-    # column 0 is in-degree, col 1 is out-degree
-    for i in xrange(n):
-        degrees[i,0] = a.in_degree(i)
-        degrees[i,1] = a.out_degree(i)
-        keylacks[i] = degrees[i,0]-a.node[i]['keys']
-
-# This is commented out because plans are not submitted to this function without obeying the <8 outgoing rule
-    # We can never make more than 8 outogoing links. Reducing these is first priority
-#    manyout = (degrees[:,1]>8).nonzero()[0]
-#    for p in manyout:
-#        qs = list(a.edge[p].iterkeys())
-#        for q in qs:
-#            if a.edge[p][q]['reversible'] and canFlip(degrees,keylacks,p,q):
-#                flip(a,p,q,degrees,keylacks)
-#            if degrees[p,1] <= 8:
-#                break
-#        else:
-#            # This runs if the for loop exits without the break
-#            print 'Could not reduce OUT-degree sufficiently for %s'%p
-
-    # It is difficult to gather more keys. Reducing key-gathering is next priority
-    # We'll process the ones with the greatest need first
-    needkeys = (keylacks>0).nonzero()[0]
-    needkeys = needkeys[np.argsort(keylacks[needkeys])][::-1]
-    for q in needkeys:
-        for p,q2 in a.in_edges(q):
-            if a.edge[p][q]['reversible'] and canFlip(degrees,keylacks,p,q):
-                flip(a,p,q,degrees,keylacks)
-            if keylacks[q] <= 0:
-                break
-#        else:
-            # This runs if the for loop exits without the break
-#            print 'Could not reduce IN-degree sufficiently for %s'%q
-
-
-def removeSince(a,m,t):
-    # Remove all but the first m edges from a (and .edge_stck)
-    # Remove all but the first t Triangules from a.triangulation
-    for i in xrange(len(a.edgeStack) - m):
-        p,q = a.edgeStack.pop()
+# Plans are compared by TK + MAX_LACK_WEIGHT*MK (see keyLack)
+MAX_LACK_WEIGHT = 2
+
+def flipPaths(origin,dest,inc,lack,outdeg,source,sink):
+    '''
+    Reverses paths of links p0->p1->...->pk where
+        source(p0) is True
+        sink(pk) is True and pk has fewer than 8 outgoing links
+    Each reversal moves an incoming link from pk to p0 (p1...pk-1 keep their degrees)
+    Repeats until there are no such paths
+
+    origin,dest: lists (indexed by link) that are updated
+    inc[p] lists the links touching p that may be reversed
+    lack[p] (in-degree minus keys) and outdeg[p] are lists that are updated
+    '''
+    n = len(lack)
+    while True:
+        # Breadth first search from all sources at once
+        # via[q] is the link the search reached q by (-1 for sources)
+        via = [None]*n
+        queue = [p for p in xrange(n) if source(p)]
+        for p in queue:
+            via[p] = -1
+        sinks = []
+        for p in queue:
+            for i in inc[p]:
+                q = dest[i]
+                if origin[i] != p or via[q] is not None:
+                    continue
+                via[q] = i
+                queue.append(q)
+                if outdeg[q] < 8 and sink(q):
+                    sinks.append(q)
+
+        if len(sinks) == 0:
+            return
+
+        # Reverse a path to each sink that is still usable after the paths before it
+        used = set()
+        for q in sinks:
+            if outdeg[q] >= 8 or not sink(q):
+                continue
+            path = []
+            p = q
+            while via[p] != -1 and not via[p] in used:
+                path.append(via[p])
+                p = origin[via[p]]
+            if via[p] != -1 or not source(p):
+                continue
+            for i in path:
+                origin[i],dest[i] = dest[i],origin[i]
+            used.update(path)
+            lack[p] += 1
+            outdeg[p] -= 1
+            lack[q] -= 1
+            outdeg[q] += 1
+
+def orientLinks(a):
+    '''
+    Chooses the directions of the reversible links (the others keep theirs)
+        First, portals have as few outgoing links beyond 8 as possible
+        Then, TK + MAX_LACK_WEIGHT*MK is minimized (see keyLack)
+            without giving any portal more than 8 outgoing links
+
+    The directions are a min-cost flow: an orientation is optimal when no path
+    of reversible links can be reversed to improve it (see flipPaths)
+    For each bound M on the lack of a single portal (starting from the best TK),
+        the lacks above M are pushed down to M and then TK is minimized
+    '''
+    links = a.links
+    origin = links.origin.tolist()
+    dest   = links.dest.tolist()
+    reversible = links.reversible.tolist()
+    inc = [[i for i in links.incident(p) if reversible[i]] for p in xrange(links.n)]
+    lack   = (links.indeg-a.portals.keys).tolist()
+    outdeg = links.outdeg.tolist()
+
+    flipPaths(origin,dest,inc,lack,outdeg,lambda p: outdeg[p] > 8,lambda q: True)
+    flipPaths(origin,dest,inc,lack,outdeg,lambda p: lack[p] < 0,lambda q: lack[q] > 0)
+
+    def weightedLack():
+        return sum([l for l in lack if l > 0]) + MAX_LACK_WEIGHT*max(max(lack),0)
+
+    best = list(origin)
+    bestlack = weightedLack()
+    for M in xrange(max(lack)-1,-1,-1):
+        flipPaths(origin,dest,inc,lack,outdeg,lambda p: lack[p] < M,lambda q: lack[q] > M)
+        if max(lack) > M:
+            # No orientation has lacks of at most M
+            break
+        flipPaths(origin,dest,inc,lack,outdeg,lambda p: lack[p] < 0,lambda q: lack[q] > 0)
+        if weightedLack() < bestlack:
+            best = list(origin)
+            bestlack = weightedLack()
+
+    for i in (links.origin != best).nonzero()[0]:
+        links.reverse(i)
+
+def checkpoint(a):
+    '''
+    Returns a checkpoint of the plan being built in a (a.links and a.triangulation)
+    rollback(a,cp) returns the plan to the state it had when checkpoint(a) returned cp
+    '''
+    return a.links.mark(),len(a.triangulation)
+
+def rollback(a,cp):
+    '''
+    Undoes every change to the plan in a since cp=checkpoint(a) was made
+        links added, links reversed and Triangles added to a.triangulation
+    Takes time proportional to the number of changes
+    Checkpoints made after cp can not be used afterward
+        (ValueError is raised for them, even if new changes were made since)
+    '''
+    m,t = cp
+    if t > len(a.triangulation):
+        raise ValueError('This checkpoint is no longer valid (changes made before it were rolled back)')
+    a.links.undo(m)
+    del a.triangulation[t:]
+
+def buildTriangle(a,verts):
+    '''
+    Makes a first generation Triangle from verts (verts[0] is its final vertex)
+        splits it and builds its links in a
+    Tries TRIES_PER_TRI times, removing the links of failed attempts
+
+    returns the Triangle (None if every attempt failed)
+    '''
+    start = checkpoint(a)
+
+    for j in xrange(TRIES_PER_TRI):
+        t0 = Triangle(verts,a,True)
+        t0.findContents()
+#        t0.randSplit() # Split triangle on a random portal
+        t0.nearSplit() # Split triangle on the nearest portal
         try:
-            a.remove_edge(p,q)
-        except Exception:
-            # The only exception should be from the edge having been reversed
-            a.remove_edge(q,p)
-#        print 'removing',p,q
-#        print a.edgeStack
-    while len(a.triangulation) > t:
-        a.triangulation.pop()
+#            print 'trying to build'
+            t0.buildGraph()
+        except Deadend as d:
+            # remove the links formed since beginning of loop
+            rollback(a,start)
+#            print 'small fail'
+        else:
+            # This build was successful
+            return t0
+
+    return None
+
+def triangulateInterval(a,perim,s,e,memo):
+    '''
+    Tries triangulations of the polygon perim[s],perim[s+1],...,perim[e] (indices wrap around)
+        whose edge perim[e],perim[s] has already been made
+
+    Each layer
+        chooses an apex k between s and e
+        makes a Triangle with vertices perim[k],perim[s],perim[e] (perim[k] is final)
+        triangulates the intervals s..k and k..e
+    The Triangle is built before the intervals, so its final vertex's edges don't exist yet
+
+    memo[(s,e)] is
+        the apex that worked the last time interval s..e was solved (tried first)
+        None if interval s..e could not be solved
+    Links inside an interval only touch its own portals,
+        so an interval's result is reused wherever it appears in another attempt
+        (with ALLOW_SUBOPTIMAL=False, out-degrees from outside the interval can matter,
+         so a remembered failure is then only a good guess)
+
+    Returns True if a feasible triangulation has been made in graph a
+    '''
+    pn = len(perim)
+    length = (e-s)%pn + 1
+    if length < 3:
+        # Base of recursion
+        return True
+
+    known = memo.get((s,e),-1)
+    if known is None:
+        return False
+
+    start = checkpoint(a)
+
+    # Offsets from s of the possible apexes
+    offsets = list(np.random.permutation(range(1,length-1)))
+    if known != -1:
+        offsets.remove((known-s)%pn)
+        offsets.insert(0,(known-s)%pn)
+
+    for offset in offsets:
+        k = (s+offset)%pn
+        t0 = buildTriangle(a,perim[[k,s,e]])
+        if t0 is None:
+            continue
+
+        if not triangulateInterval(a,perim,s,k,memo) or \
+           not triangulateInterval(a,perim,k,e,memo):
+            # remove the links formed since beginning of loop
+            rollback(a,start)
+            continue
+
+        # This will be a list of the first generation triangles
+        a.triangulation.append(t0)
+
+        memo[(s,e)] = k
+        return True
+
+    # Could not find a solution
+    memo[(s,e)] = None
+    return False
 
 def triangulate(a,perim):
     '''
-    Recursively tries every triangulation in search a feasible one
-        Each layer
-            makes a Triangle out of three perimeter portals
-            for every feasible way of max-fielding that Triangle
-                try triangulating the two perimeter-polygons to the sides of the Triangle
+    Tries triangulations in search of a feasible one
+        The first Triangle is made of three consecutive perimeter portals
+            (using the middle one i as final vertex will cause no 2 first generation triangles to have same final vertex)
+        The rest of the polygon (i+1 through i-1) is left to triangulateInterval
+    Solutions of intervals are remembered between attempts
 
     Returns True if a feasible triangulation has been made in graph a
     '''
@@ -132,50 +257,23 @@ def triangulate(a,perim):
         # Base of recursion
         return True
 
-    try:
-        startStackLen = len(a.edgeStack)
-    except AttributeError:
-        startStackLen = 0
-        a.edgeStack = []
-    try:
-        startTriLen = len(a.triangulation)
-    except AttributeError:
-        startTriLen = 0
+    if not hasattr(a,'links'):
+        a.links = LinkTable.LinkTable(a.order())
+    if not hasattr(a,'triangulation'):
         a.triangulation = []
+    start = checkpoint(a)
 
-#    odegrees = [a.out_degree(p) for p in perim
-#    order = np.argsort(odegrees)
+    memo = {}
 
-    # Try all possible first generation triangles with two edges on boundary that both use node i (using i as final vertex will cause no 2 first generation triangles to have same final vertex)
     for i in np.random.permutation(range(0,pn)):
-#        print perim
 #        print 'using %s as final'%perim[i]
-        for j in xrange(TRIES_PER_TRI):
-            t0 = Triangle(perim[[i,i-1,(i+1)%pn]],a,True)
-            t0.findContents()
-#            t0.randSplit() # Split triangle on a random portal
-            t0.nearSplit() # Split triangle on the nearest portal
-            try:
-#                print 'trying to build'
-                t0.buildGraph()
-            except Deadend as d:
-                # TODO when allowing suboptimal plans, this block would be unnecessary if first generation triangles were made in the right order: see Triangle.buildGraph
-                # remove the links formed since beginning of loop
-                removeSince(a,startStackLen,startTriLen)
-#                print 'small fail'
-            else:
-                # This build was successful. Break from the loop
-#                print 'build succeeded'
-                break
-        else:
-            # The loop ended "normally" so this triangle failed
-#            print 'big fail'
+        t0 = buildTriangle(a,perim[[i,i-1,(i+1)%pn]])
+        if t0 is None:
             continue
 
-#        print 'continuing with',perim[range(i+1-pn,i)]
-        if not triangulate(a,perim[range(i+1-pn,i)]): # i+1 through i-1
+        if not triangulateInterval(a,perim,(i+1)%pn,(i-1)%pn,memo):
             # remove the links formed since beginning of loop
-            removeSince(a,startStackLen,startTriLen)
+            rollback(a,start)
             continue
 
         # This will be a list of the first generation triangles
@@ -188,13 +286,105 @@ def triangulate(a,perim):
     return False
     
 def maxFields(a):
-    n = a.order()
-
-    pts = np.array([ a.node[i]['xy'] for i in xrange(n) ])
+    pts = a.portals.xy
 
     perim = np.array(geometry.getPerim(pts))
+
     if not triangulate(a,perim):
         return False
-    flipSome(a)
+    orientLinks(a)
 
     return True
+
+def keyLack(a):
+    '''
+    returns TK,MK
+        TK is the total number of missing keys
+        MK is the maximum number of missing keys for any single portal
+    '''
+    lacks = np.maximum(a.links.indeg-a.portals.keys,0)
+    return lacks.sum(),lacks.max()
+
+def newPlan(a):
+    '''
+    Returns a plan for the same portals as a, without any links or Triangles
+        the portal data (a.portals) is shared, not copied
+    '''
+    b = a.__class__()
+    b.add_nodes_from(xrange(a.order()))
+    b.portals = a.portals
+    return b
+
+# The plan whose portals sampleFields uses (set in each worker by setSampleBase)
+sampleBase = None
+
+def setSampleBase(a):
+    global sampleBase
+    sampleBase = a
+
+def sampleFields(seed):
+    '''
+    One sample for sampleBest (made to run in a process pool)
+    returns a new plan for the portals of sampleBase with fields (without portals, since the caller has them)
+        or None if maxFields failed
+    '''
+    b = newPlan(sampleBase)
+    np.random.seed(seed)
+    if not maxFields(b):
+        return None
+    del b.portals
+    return b
+
+def sampleBest(a,samples,seed,processes=None):
+    '''
+    Runs maxFields on samples new plans for the portals of a in parallel
+        Each worker gets the portals once, and only sends back the links and triangulation
+        Sample i uses random seed seed+i, so results can be reproduced
+    Tries to minimize TK + MAX_LACK_WEIGHT*MK (see keyLack)
+        Stops early if some plan needs no extra keys
+
+    returns the best plan found (None if every sample failed)
+    '''
+    jobs = xrange(seed,seed+samples)
+
+    # Workers share this instead of making their own
+    a.portals.index()
+
+    if samples == 1:
+        setSampleBase(a)
+        plans = map(sampleFields,jobs)
+    else:
+        pool = Pool(processes,setSampleBase,(a,))
+        # imap keeps the sample order, so ties and early stops don't depend on timing
+        plans = pool.imap(sampleFields,jobs)
+
+    bestgraph = None
+    bestlack = np.inf
+    for i,b in enumerate(plans):
+        if b is None:
+            print 'Randomization failure (seed %s)'%(seed+i)
+            continue
+        b.portals = a.portals
+
+        TK,MK = keyLack(b)
+        weightedlack = TK+MAX_LACK_WEIGHT*MK
+
+        if weightedlack < bestlack:
+            print 'IMPROVEMENT (seed %s):\n\ttotal: %s\n\tmax:   %s\n\tweighted: %s'%\
+                   (seed+i,TK,MK,weightedlack)
+            bestgraph = b
+            bestlack  = weightedlack
+            bestTK  = TK
+            bestMK  = MK
+
+        if weightedlack == 0:
+            print 'KEY PERFECTION'
+            break
+
+    if samples > 1:
+        pool.terminate()
+
+    if bestgraph is not None:
+        print 'Choosing plan requiring %s additional keys, max of %s from single portal'%(bestTK,bestMK)
+
+    return bestgraph
@@ -20,11 +20,30 @@ You should have received a copy of the GNU General Public License
 along with Maxfield.  If not, see <http://www.gnu.org/licenses/>.
 '''
 from sys import stdout
+import time
 import branch_bound
 np = branch_bound.np
 
 MAX_BRANCHES = 15000
 
+# Set to False to search with a list of OTSPstate objects instead of OTSPbeam arrays
+ARRAY_BEAM = True
+
+# Drop OTSPbeam children that are equivalent to (or worse than) another child
+PRUNE_DOMINATED = True
+# Each child is compared with up to this many better children that have agents at the same positions
+DOMINANCE_CHECKS = 8
+
+# Look for a better assignment near the one found by the beam search (see improveVisits)
+IMPROVE_VISITS = True
+# improveVisits tries swapping the agents of visits up to this far apart
+SWAP_WINDOW = 4
+# improveVisits stops after this many passes over the visits
+IMPROVE_PASSES = 2
+
+# With a time budget, the beam search gets this share of it and improveVisits gets the rest
+BEAM_SHARE = 0.8
+
 # This could be used if more splits are wanted than are possible
 infState = branch_bound.InfState()
 
@@ -68,7 +87,7 @@ class OTSPstate:
         # The time at which this agent could make the next visit
         
         # The index of the last visit this agent made
-        lastvisit = self.lastat[-1][agent]
+        lastvisit = self.lastat[self.m-1][agent]
 
 #        print len(self.time)
 #        print self.d.shape
@@ -77,7 +96,7 @@ class OTSPstate:
 
         # Assume agent's initial deployment is instantaneous
         if lastvisit is None:
-            return self.time[-1]
+            return self.time[self.m-1]
 
         # The node at which agent made his last visit
         lastpos   = self.order[lastvisit]
@@ -91,12 +110,12 @@ class OTSPstate:
 #        print '  lasttime',lasttime
 #        print '  nextpos',nextpos
 
-        t = max( self.time[-1] , lasttime + self.d[nextpos,lastpos] )
+        t = max( self.time[self.m-1] , lasttime + self.d[nextpos,lastpos] )
 #        print '  t',t
         return t
 
         # He makes it either at the same time as the previous visit or as soon as he arrives at nextpos
-        return max( self.time[-1] , lasttime + self.d[nextpos,lastpos] )
+        return max( self.time[self.m-1] , lasttime + self.d[nextpos,lastpos] )
 
     def split(self,num):
         '''
@@ -135,45 +154,363 @@ class OTSPstate:
 
         return children
 
-    def calcTimes(self):
+    def calcTimes(self,start=1,last=None,bound=np.inf,log=None,prune=False):
         '''
         Calculates self.time and self.lastat
             Uses data from self.d and self.visit2agent
         Assumes self.time[0] should be 0
         self.time and self.lastat are overwritten
+
+        start: the first visit whose time is recalculated
+            self.time and self.lastat are trusted before start
+            (everything is recalculated if they are not complete)
+        last:  if given, visit2agent has only changed for visits start through last
+            since the previous calculation
+            once the timeline after last matches the old one, the rest is kept
+        bound: give up as soon as a visit is made later than this
+            self.time and self.lastat are then left partly recalculated
+        log:   if given, a list to which (i,time,lastat) of each visit i is appended
+            before it is overwritten (see undoTimes)
+        prune: (with last) also give up once no visit after last can be made earlier than before
+            and the visits recalculated so far are not earlier on the whole
+            (so neither the last visit nor the sum of the times can improve)
+
+        returns the time of the last visit (inf if it gave up)
         '''
         nvisits = len(self.order)
 
-        # These could be pre-allocated if agentsNewTime didn't use negativ index
-
-        # Same initialization as in __init__
-        self.time        = [0.]
-        self.m           = 1
-        # Agent 0 makes visit 0
-        self.lastat = [ [0]+[None]*(self.nagents-1) ]
-
-        for i in xrange(1,nvisits):
+        if start < 1 or len(self.time) != nvisits or len(self.lastat) != nvisits:
+            # Same initialization as in __init__
+            start = 1
+            self.time   = [0.]*nvisits
+            # Agent 0 makes visit 0
+            self.lastat = [None]*nvisits
+            self.lastat[0] = [0]+[None]*(self.nagents-1)
+            last = None
+
+        # oldtime[i-start] is the time of visit i before recalculation
+        oldtime = []
+        # The sum of the recalculated times minus the sum of their old times
+        delta = 0.
+
+        for i in xrange(start,nvisits):
+            self.m = i
             agent = self.visit2agent[i]
 
             t = self.agentsNewTime(agent)
 
-            self.time.append(t)
-            self.m += 1
-
             # Everyone has same position except for agent
-            self.lastat.append(list(self.lastat[-1]))
-            self.lastat[-1][agent] = i
-            
+            newlast = list(self.lastat[i-1])
+            newlast[agent] = i
+
+            if last is not None and i > last and newlast == self.lastat[i]:
+                # Agents are at the same positions as before, compare the times they were there
+                changed = [ (self.time[j],oldtime[j-start]) for j in newlast \
+                            if not (j is None or j < start or j == i) ]
+                if t == self.time[i] and all([new == old for new,old in changed]):
+                    # Same agents, positions and times from here on
+                    break
+                if prune and t >= self.time[i] and delta >= 0 and \
+                   all([new >= old for new,old in changed]):
+                    # Every later visit will be made at its old time or later
+                    self.value = np.inf
+                    return self.value
+
+            oldtime.append(self.time[i])
+            delta += t-self.time[i]
+            if log is not None:
+                log.append((i,self.time[i],self.lastat[i]))
+            self.time[i]   = t
+            self.lastat[i] = newlast
+
+            if t > bound:
+                self.value = np.inf
+                return self.value
+
+        self.m = nvisits
         self.value = self.time[-1]
         return self.value
 
+    def undoTimes(self,log,value):
+        # Undoes the changes calcTimes recorded in log (value is the old self.value)
+        for i,t,lastat in reversed(log):
+            self.time[i]   = t
+            self.lastat[i] = lastat
+        self.m = len(self.order)
+        self.value = value
+
+def improveVisits(d,order,nagents,visit2agent,deadline=None):
+    '''
+    Local search for a better assignment of visits to agents
+    d,order,nagents: as in OTSPstate
+    visit2agent: a complete assignment (e.g. from getVisits)
+    deadline: if given, the time.time() at which to stop searching
+
+    Tries these moves, keeping any that finish sooner
+    (or finish at the same time with the visits made earlier on the whole)
+        give one visit to a different agent
+        swap the agents of a visit and one of the next SWAP_WINDOW visits
+        give a run of consecutive visits by one agent to a different agent
+    Only the timeline after the first changed visit is recalculated for each move
+        and only the visits it changed are restored if the move is not kept
+    Stops after IMPROVE_PASSES passes over the visits
+
+    returns visit2agent,time
+    '''
+    state = OTSPstate(d,order,nagents,list(visit2agent))
+    state.calcTimes()
+    v = state.visit2agent
+    nvisits = len(order)
+
+    def tryMove(visits,agents):
+        # Reassign visits (ascending) to agents, keep it if it helps
+        start,last = visits[0],visits[-1]
+        oldagents = [v[i] for i in visits]
+        oldvalue = state.value
+
+        for i,agent in zip(visits,agents):
+            v[i] = agent
+        log = []
+        value = state.calcTimes(start,last,oldvalue,log,True)
+        if value <= oldvalue:
+            # The sum of all visit times changes only where calcTimes changed them
+            newtotal = total[0] + sum([state.time[i]-t for i,t,lastat in log])
+            if value < oldvalue or newtotal < total[0]:
+                total[0] = newtotal
+                return True
+
+        for i,agent in zip(visits,oldagents):
+            v[i] = agent
+        state.undoTimes(log,oldvalue)
+        return False
+
+    total = [sum(state.time)]
+
+    improved = True
+    passes = 0
+    while improved and passes < IMPROVE_PASSES:
+        improved = False
+        passes += 1
+        for i in xrange(1,nvisits):
+            if deadline is not None and time.time() > deadline:
+                return v,state.time
+
+            for agent in xrange(nagents):
+                if agent != v[i] and tryMove([i],[agent]):
+                    improved = True
+
+            for j in xrange(i+1,min(i+1+SWAP_WINDOW,nvisits)):
+                if v[j] != v[i] and tryMove([i,j],[v[j],v[i]]):
+                    improved = True
+
+            # Runs start where the agent changes
+            if v[i] == v[i-1]:
+                continue
+            j = i+1
+            while j < nvisits and v[j] == v[i]:
+                j += 1
+            if j-i < 2:
+                continue
+            for agent in xrange(nagents):
+                if agent != v[i] and tryMove(range(i,j),[agent]*(j-i)):
+                    improved = True
+
+    return v,state.time
+
+
+class OTSPbeam:
+    def __init__(self,d,order,nagents):
+        '''
+        The whole beam of partial OTSP solutions, stored as arrays
+            (equivalent to a list of OTSPstates that have all made the same number of visits)
+
+        d: distance matrix
+        order: order in which nodes must be visited
+        nagents: number of agents
+
+        For state b in the beam
+            lastpos[b,j]  is the node where agent j most recently was (-1 if not deployed)
+            lasttime[b,j] is the time at which agent j was at lastpos[b,j] (-inf if not deployed)
+            value[b]      is the time at which the most recent visit was made
+
+        Instead of copying visit2agent and time into every child, each level keeps
+            parents[i][b] the index (in level i-1) of the state that produced state b
+            agents[i][b]  the agent who made visit i in state b
+            times[i][b]   the time at which visit i was made in state b
+        '''
+        self.d = d
+        self.order = order
+        self.nagents = nagents
+
+        # Random codes for hashing sets of positions (position -1 uses poscodes[0])
+        self.poscodes = (np.random.RandomState(0).random_sample(d.shape[0]+1)*2**62).astype(np.int64)
+
+        # Agent 0 makes visit 0 at time 0
+        self.lastpos  = -np.ones([1,nagents],dtype=int)
+        self.lastpos[0,0] = order[0]
+        # Undeployed agents can be anywhere, so their walk never delays a visit
+        self.lasttime = np.empty([1,nagents])
+        self.lasttime.fill(-np.inf)
+        self.lasttime[0,0] = 0.
+        self.value = np.zeros(1)
+
+        self.m = 1 # number of visits that have already been made
+
+        self.parents = [np.zeros(1,dtype=int)]
+        self.agents  = [np.zeros(1,dtype=int)]
+        self.times   = [np.zeros(1)]
+
+    def childValues(self,num):
+        '''
+        num: number of children that will be kept
+
+        returns values
+            values[b,j] is the time at which visit m is made if state b gives it to agent j
+        '''
+        if self.m >= len(self.order):
+            raise branch_bound.CantSplit()
+
+        nextpos = self.order[self.m]
+        # Agents that have not made a visit are at -1 (LazyDists gives 0, added to -inf)
+        walk = self.d[nextpos,self.lastpos]
+
+        # Agents make the visit either at the same time as the previous visit or as soon as they arrive
+        values = np.maximum( self.value.reshape([-1,1]) , self.lasttime + walk )
+
+        if PRUNE_DOMINATED:
+            # branch_bound.batch_branch_bound never keeps infinite children
+            # Only the best children could survive, even if some of them are dropped
+            pool = branch_bound.lowest(values,2*num)
+            values.reshape(-1)[pool[self.dominated(values,pool)]] = np.inf
+
+        return values
+
+    def dominated(self,values,pool):
+        '''
+        values: the child values computed in childValues
+        pool:   flat indices (into values) of the children to compare
+
+        Agents are interchangeable, so a child's future only depends on
+            the set of (position,time) pairs of its agents and its value
+        A child is dominated if another child has agents at the same positions,
+            each available no later, and a value no greater
+        Of a group of identical children, only the first is not dominated
+
+        returns dominated
+            dominated[i] is True if child pool[i] is dominated by another child in pool
+        '''
+        nagents = self.nagents
+        nchildren = len(pool)
+        value = values.reshape(-1)[pool]
+
+        # Child c = b*nagents+j is state b after agent j makes the visit
+        parent = pool // nagents
+        agent  = pool %  nagents
+        rows = np.arange(nchildren)
+        pos  = self.lastpos [parent]
+        time = self.lasttime[parent]
+        pos [rows,agent] = self.order[self.m]
+        time[rows,agent] = value
+
+        # Hash of the set of positions (the sum doesn't depend on agent labels)
+        # Integer overflow just wraps around
+        poshash = self.poscodes[pos+1].sum(1)
+
+        # Put children with the same positions together, lowest value first
+        bygroup = np.lexsort([value,poshash])
+        poshash = poshash[bygroup]
+        value   = value  [bygroup]
+
+        # Canonical form: agents sorted by position, then by time
+        # Since times are less than width, one number orders both
+        width = value.max()+1.
+        canon = np.sort(pos[bygroup]*width + time[bygroup],1)
+
+        # start[c] is where the group of (sorted) child c begins
+        newgroup = np.ones(nchildren,dtype=bool)
+        newgroup[1:] = poshash[1:] != poshash[:-1]
+        inds  = np.arange(nchildren)
+        start = np.maximum.accumulate(np.where(newgroup,inds,0))
+        rank  = inds - start
+
+        isdominated = np.zeros(nchildren,dtype=bool)
+        for k in xrange(min(DOMINANCE_CHECKS,rank.max())):
+            # Compare each child with the kth member of its group
+            i = (rank > k).nonzero()[0]
+            j = start[i]+k
+            isdominated[i] |= np.all(canon[j] <= canon[i],1) & (value[j] <= value[i])
+
+        dominated = np.empty(nchildren,dtype=bool)
+        dominated[bygroup] = isdominated
+        return dominated
+
+    def advance(self,values,keep):
+        '''
+        values: the output of childValues
+        keep:   flat indices (into values) of the children that make up the new beam
+        '''
+        parent = keep // self.nagents
+        agent  = keep %  self.nagents
+        newtime = values.reshape(-1)[keep]
+
+        self.lastpos  = self.lastpos [parent]
+        self.lasttime = self.lasttime[parent]
+        self.value    = newtime
+
+        rows = np.arange(len(keep))
+        self.lastpos [rows,agent] = self.order[self.m]
+        self.lasttime[rows,agent] = newtime
 
-def getVisits(dists,order,nagents):
+        self.parents.append(parent)
+        self.agents .append(agent)
+        self.times  .append(newtime)
+
+        self.m += 1
+
+    def remaining(self):
+        # Number of visits that have not been made
+        return len(self.order) - self.m
+
+    def visits(self,b):
+        '''
+        Follows parent pointers back from state b of the current level
+        returns visit2agent,time in the same format as OTSPstate
+        '''
+        visit2agent = [0]*self.m
+        time        = [0.]*self.m
+        for i in xrange(self.m-1,0,-1):
+            visit2agent[i] = int(self.agents[i][b])
+            time[i]        = float(self.times[i][b])
+            b = self.parents[i][b]
+
+        return visit2agent,time
+
+def beamSearch(dists,order,nagents,lo,callback=None,deadline=None):
+    '''
+    The same beam search as branch_bound.branch_bound(OTSPstate(...),lo,lo*nagents),
+        with ties broken arbitrarily, so equally good children may be kept differently
+        every level of the beam is expanded in one array operation
+        with PRUNE_DOMINATED, children no better than an equivalent child are dropped first
+    deadline: see branch_bound.batch_branch_bound
+    returns visit2agent,time of the best state found
+    '''
+    beam = OTSPbeam(dists,order,nagents)
+    beam,best,value = branch_bound.batch_branch_bound(beam,lo,callback,deadline)
+    return beam.visits(best)
+
+def getVisits(dists,order,nagents,timeBudget=None,verbose=True):
     '''
     dists:   a distance matrix
     order:   the order in which nodes must be visited
              duplicates allowed
     nagents: the number of agents available to make the visits
+    timeBudget: if given, the number of seconds the search may take
+             a greedy assignment is made first
+             the beam narrows as needed to finish in time
+             when time runs out, the best partial assignment is finished greedily
+             improveVisits then runs until the end of the budget (at most)
+             (without a budget, improveVisits makes its IMPROVE_PASSES passes)
+    verbose: print progress
              
     returns visits,time
               visits[i] = j means the ith visit should be performed by agent j
@@ -181,18 +518,39 @@ def getVisits(dists,order,nagents):
     '''
 
     # This callback prints the number of iterations
-    print 'Planning',len(order),'agent movements:'
     c = [0]
     def cb():
         c[0] += 1
         print c[0],
         stdout.flush()
 
-    root = OTSPstate(dists,order,nagents)
+    if verbose:
+        print 'Planning',len(order),'agent movements:'
+    else:
+        cb = None
+
     LO = MAX_BRANCHES // nagents
-    state,value = branch_bound.branch_bound(root, LO , LO*nagents , cb)
 
-    return state.visit2agent,state.time
+    deadline = None
+    if timeBudget is not None:
+        start = time.time()
+        deadline = start + timeBudget
+        # A beam of width 1 is a greedy assignment
+        greedy = beamSearch(dists,order,nagents,1)
+        visits = beamSearch(dists,order,nagents,LO,cb,start+BEAM_SHARE*timeBudget)
+        if greedy[1][-1] < visits[1][-1]:
+            visits = greedy
+    elif ARRAY_BEAM:
+        visits = beamSearch(dists,order,nagents,LO,cb)
+    else:
+        root = OTSPstate(dists,order,nagents)
+        state,value = branch_bound.branch_bound(root, LO , LO*nagents , cb)
+        visits = state.visit2agent,state.time
+
+    if IMPROVE_VISITS:
+        visits = improveVisits(dists,order,nagents,visits[0],deadline)
+
+    return visits
 
 if __name__=='__main__':
     import geometry
@@ -24,21 +24,17 @@ import re
 import sys
 from docopt import docopt
 import networkx as nx
-from lib import makeFields,PlanPrinter,geometry,agentOrder
+from lib import makeFields,PlanPrinter,geometry,agentOrder,PortalTable,LinkTable
 import pickle
 
 args = sys.argv
 
-# We could take many samples in an attempt to reduce number of keys to farm
-# This is the number of samples to take since the last improvement
-EXTRA_SAMPLES = 1
-
 copystr = 'Maxfield Copyright (C) 2015 Jonathan Baker: babamots@gmail.com'
 print copystr
 
 __doc__ = '''
 Usage:
-  maxfield.py [-b] [-n <agent_count>] <input_file> [<output_directory>] [<output_file>]
+  maxfield.py [-b] [-n <agent_count>] [-s <samples>] [-k <key_file>] [--seed <seed>] [--time-budget <seconds>] [--sweep <agent_counts>] <input_file> [<output_directory>] [<output_file>]
 
 Description:
 
@@ -64,6 +60,22 @@ Description:
 Options:
   -b         Make maps blue instead of green
   -n agents  Number of agents [default: 1]
+  -s samples  Number of plans to try, keeping the one needing fewest extra keys [default: 1]
+              the samples are made in parallel
+  -k keyfile  Take the number of keys for each portal from keyfile
+             keyfile is a .csv like input_file, listing the same portals in the same order
+             input_file must be a .pkl: its fields are kept, but the directions and
+             order of its links are chosen again for the new keys
+  --seed seed
+             Random seed for the first sample (sample i uses seed+i)
+             the same seed and input give the same plans
+  --time-budget seconds
+             Limit the time spent assigning links to agents
+             the best assignment found in that time is used
+  --sweep agent_counts
+             Instead of making link schedules, compare numbers of agents
+             e.g. "1-10" or "2,4,8"
+             writes a table of time, distance and AP to agentSweep.txt
 '''
 
 #if len(args) < 3:
@@ -72,6 +84,45 @@ Options:
 
 #print __doc__
 
+def readPortals(input_file):
+    '''
+    Reads a .csv input file (see the usage)
+    returns names,locs,keys
+        locs[i] is the [lat,lng] of portal i (in degrees)
+    '''
+    np = geometry.np
+    names = []
+    keys = []
+    locs = []
+    #                             ------------- URL -------------
+    #                      name  ;       lat      ,  lng         ;     keys
+    urlpat = re.compile('^([^;]*);.*ll=([-0-9\.]+),([-0-9\.]+)\s*;?\s*(\d+)?')
+    #                      name  ;     lat         ;     lng         ;     keys
+    cvspat = re.compile('^([^;]*);\s*([-0-9\.]+)\s*;\s*([-0-9\.]+)\s*;?\s*(\d+)?')
+    # each line should be id,name,lat,long,keys
+    with open(input_file,'r') as fin:
+        for line in fin:
+            m = urlpat.match(line)
+            if m is None:
+                m = cvspat.match(line)
+            if m is None:
+                continue
+            g = m.groups()
+#            print g
+
+            names.append(g[0])
+
+            locs.append( np.array([float(g[1]),float(g[2])] ))
+
+            if g[3] is None:
+                keys.append(0)
+            else:
+                keys.append(int(g[3]))
+
+    locs = np.array(locs,dtype=float)
+#    print locs
+    return names,locs,keys
+
 def main():
     args = docopt(__doc__)
 
@@ -105,122 +156,74 @@ def main():
         print 'Numer of agents should be positive'
         exit()
 
-    input_file = args['<input_file>']
-
-    if input_file[-3:] != 'pkl':
-        a = nx.DiGraph()
+    timeBudget = None
+    if not args['--time-budget'] is None:
+        timeBudget = float(args['--time-budget'])
+        if timeBudget <= 0:
+            print 'Time budget should be positive'
+            exit()
 
-        locs = []
-        #                             ------------- URL -------------
-        #                      name  ;       lat      ,  lng         ;     keys
-        urlpat = re.compile('^([^;]*);.*ll=([-0-9\.]+),([-0-9\.]+)\s*;?\s*(\d+)?')
-        #                      name  ;     lat         ;     lng         ;     keys
-        cvspat = re.compile('^([^;]*);\s*([-0-9\.]+)\s*;\s*([-0-9\.]+)\s*;?\s*(\d+)?')
-        i = 0
-        # each line should be id,name,lat,long,keys
-        with open(input_file,'r') as fin:
-            for line in fin:
-                m = urlpat.match(line)
-                if m is None:
-                    m = cvspat.match(line)
-                if m is None:
-                    continue
-                g = m.groups()
-#                print g
+    sweep = None
+    if not args['--sweep'] is None:
+        sweep = []
+        for part in args['--sweep'].split(','):
+            ends = [int(k) for k in part.split('-')]
+            sweep.extend(range(ends[0],ends[-1]+1))
+        if len(sweep) == 0 or min(sweep) <= 0:
+            print 'Numbers of agents should be positive'
+            exit()
 
-                a.add_node(i)
-                a.node[i]['name'] = g[0]
+    samples = int(args['-s'])
+    if samples <= 0:
+        print 'Number of samples should be positive'
+        exit()
 
-                locs.append( np.array([float(g[1]),float(g[2])] ))
+    if args['--seed'] is None:
+        seed = np.random.randint(2**31-samples)
+    else:
+        seed = int(args['--seed'])
 
-                if g[3] is None:
-                    a.node[i]['keys'] = 0
-                else:
-                    a.node[i]['keys'] = int(g[3])
+    input_file = args['<input_file>']
 
-                i += 1
+    if input_file[-3:] != 'pkl':
+        if not args['-k'] is None:
+            print 'A key file (-k) can only be used with a .pkl input_file'
+            print 'Put the keys in %s instead'%input_file
+            exit()
 
-        n = a.order() # number of nodes
+        a = nx.DiGraph()
 
-        locs = np.array(locs,dtype=float)
-#        print locs
+        names,locs,keys = readPortals(input_file)
+        for i in xrange(len(names)):
+            a.add_node(i)
 
         # This part assumes we're working with decimal latitude-longitude data
         locs = geometry.LLtoRads(locs)
         xyz  = geometry.radstoxyz(locs)
-        xy   = geometry.gnomonicProj(locs,xyz)
-
-        for i in xrange(n):
-            a.node[i]['geo'] = locs[i]
-            a.node[i]['xyz'] = xyz [i]
-            a.node[i]['xy' ] = xy  [i]
-            
-        makeFields.maxFields(a)
-
-        '''
-        # EXTRA_SAMPLES attempts to get graph with few missing keys
-        # Try to minimuze TK + 2*MK where
-        #  TK is the total number of missing keys
-        #   MK is the maximum number of missing keys for any single portal
-        bestgraph = None
-        bestlack = np.inf
-        bestTK = np.inf
-        bestMK = np.inf
-
-        sinceImprove = 0
-
-        while sinceImprove<EXTRA_SAMPLES:
-            b = a.copy()
-
-            sinceImprove += 1
-
-            if not makeFields.maxFields(b):
-                print 'Randomization failure\nThe program may work if you try again. It is more likely to work if you remove some protals.'
-                continue
 
-            TK = 0
-            MK = 0
-            for j in xrange(n):
-                keylack = max(b.in_degree(j)-b.node[j]['keys'],0)
-                TK += keylack
-                if keylack > MK:
-                    MK = keylack
-            
-            weightedlack = TK+2*MK
-
-            if weightedlack < bestlack:
-                sinceImprove = 0
-                print 'IMPROVEMENT:\n\ttotal: %s\n\tmax:   %s\n\tweighted: %s'%\
-                       (TK,MK,weightedlack)
-                bestgraph = b
-                bestlack  = weightedlack
-                bestTK  = TK
-                bestMK  = MK
-            else:
-                print 'this time:\n\ttotal: %s\n\tmax:   %s\n\tweighted: %s'%\
-                       (TK,MK,weightedlack)
-
-            if weightedlack == 0:
-                print 'KEY PERFECTION'
-                bestlack  = weightedlack
-                bestTK  = TK
-                bestMK  = MK
-                break
-
-#            if all([ b.node[i]['keys'] <= b.out_degree(i) for i in xrange(n) ]):
-#                print 'All keys used. Improvement impossible'
-#                break
-#            print '%s tries since improvement'%sinceImprove
-
-        if bestgraph is None:
-            print 'EXITING RANDOMIZATION LOOP WITHOUT SOLUTION!'
-            print ''
+        # The projection needs all portals on one side of its center
+        center,disproof = geometry.commonHemisphere(xyz,True)
+        if center is None and disproof is None:
+            print 'Could not find a hemisphere containing all of the portals'
+            print 'They may be too far apart to be mapped together'
+            exit()
+        if center is None:
+            print 'The portals are too far apart to be mapped together'
+            print 'No hemisphere contains all of these:'
+            for i in disproof:
+                print '    %s'%names[i]
             exit()
 
-        print 'Choosing plan requiring %s additional keys, max of %s from single portal'%(bestTK,bestMK)
+        xy   = geometry.gnomonicProj(locs,xyz,center)
 
-        a = bestgraph
-        '''
+        a.portals = PortalTable.PortalTable(names,keys,locs,xyz,xy)
+
+
+        print 'Random seed:',seed
+        a = makeFields.sampleBest(a,samples,seed)
+        if a is None:
+            print 'Randomization failure\nThe program may work if you try again. It is more likely to work if you remove some protals.'
+            exit()
 
         # Attach to each edge a list of fields that it completes
         for t in a.triangulation:
@@ -233,11 +236,40 @@ def main():
     else:
         with open(input_file,'r') as fin:
             a = pickle.load(fin)
+        PortalTable.portalsOf(a)
+        LinkTable.linksOf(a)
+
+        if not args['-k'] is None:
+            names,locs,keys = readPortals(args['-k'])
+            if list(a.portals.name) != names:
+                print 'The portals in %s are not the ones in the plan'%args['-k']
+                exit()
+            a.portals.keys = np.array(keys,dtype=int)
+
+            # Start from the order the links were planned in (the order they were added)
+            a.links.reorder(np.arange(len(a.links)))
+            a.links.clearFields()
+
+            makeFields.orientLinks(a)
+            TK,MK = makeFields.keyLack(a)
+            print 'New plan requires %s additional keys, max of %s from single portal'%(TK,MK)
+
+            for t in a.triangulation:
+                t.markEdgesWithFields()
+
+            agentOrder.improveEdgeOrder(a)
+
+            with open(output_directory+output_file,'w') as fout:
+                pickle.dump(a,fout)
     #    agentOrder.improveEdgeOrder(a)
     #    with open(output_directory+output_file,'w') as fout:
     #        pickle.dump(a,fout)
 
-    PP = PlanPrinter.PlanPrinter(a,output_directory,nagents,COLOR)
+    if not sweep is None:
+        PlanPrinter.agentSweep(a,output_directory,sweep,timeBudget)
+        return
+
+    PP = PlanPrinter.PlanPrinter(a,output_directory,nagents,COLOR,timeBudget)
     PP.keyPrep()
     PP.agentKeys()
     PP.planMap()